@@ -1,7 +1,18 @@
 # Author
 # William Lucca
 
-from math import sin, pi
+from functools import lru_cache
+from math import pi
+
+import numpy as np
+
+# NumPy types of little-endian two's complement samples by width in bytes
+PCM_TYPES = {1: '<i1', 2: '<i2', 4: '<i4', 8: '<i8'}
+
+# Wavetable oscillator settings (see wavetable)
+WAVEFORMS = ['sine', 'square']
+WAVETABLE_SIZE = 4096  # Points in one cycle of a wave
+WAVETABLE_CACHE = 16  # Most tables kept at once
 
 
 class Wave:
@@ -26,64 +37,49 @@ class Wave:
         self.offset = offset
     
     def sinesamples(self, numsecs, bytespersamp=2, sampfreq=44100,
-                    fadein=0, fadeout=0) -> bytes:
+                    fadein=0, fadeout=0, start=0, numsamps=None) -> bytes:
         """Get audio samples from the wave's attributes using a sine function
         
         Default parameters use standard audio quality. Only supports mono.
         :param numsecs: The number of seconds to generate
-        :param bytespersamp: The depth of one sample in bytes
+        :param bytespersamp: The depth of one sample in bytes (3 for 24-bit)
         :param sampfreq: The sample frequency (in Hz)
         :param fadein: How many seconds to fade in for
         :param fadeout: How many seconds to fade out for
+        :param start: The first sample to generate, for generating the sound
+        in blocks
+        :param numsamps: How many samples to generate (up to the end of the
+        sound by default)
         :return: The audio samples as a bytes object
         :rtype: bytes
         """
         
-        # Initialize return samples as a bytes object
-        numsamps = int(numsecs * sampfreq)
-        samples = bytearray(numsamps * bytespersamp)
-        
-        # Index in samples bytearray
-        s = 0
-        
-        for i in range(numsamps):
-            # Get x-value (seconds)
-            x = i / sampfreq
-            
-            fademult = 1.0
-            # Fade in
-            if x < fadein:
-                # [0.0, 1.0] over the course of fade in time
-                fademult = x / fadein
-            
-            # Fade out
-            if (numsecs - x) < fadeout:
-                # [1.0, 0.0] over the course of fade out time
-                fademult = (numsecs - x) / fadeout
-            
-            # Value of sine function [0, 1]
-            b = 2 * pi * self.freq
-            sinevalue = fademult * sin(b * (x - self.offset)) / 2 + 0.5
-            
-            # Map to [-minvolume, maxvolume] and push to samples
-            sampvolume = int(self.minvolume + self.amplitude * sinevalue)
-            samplebytes = twoscompbytes(sampvolume, bytespersamp)
-            for byte in samplebytes:
-                samples[s] = byte
-                s += 1
-        
-        return bytes(samples)
+        # Time of each sample (seconds) and its fade multiplier
+        x = sampletimes(numsecs, sampfreq, start, numsamps)
+        fademult = fademults(x, numsecs, fadein, fadeout)
+        
+        # Value of sine function [0, 1]
+        b = 2 * pi * self.freq
+        sinevalue = fademult * np.sin(b * (x - self.offset)) / 2 + 0.5
+        
+        # Map to [-minvolume, maxvolume], truncating like int()
+        sampvolume = np.trunc(self.minvolume + self.amplitude * sinevalue)
+        return arraytopcm(sampvolume, bytespersamp)
     
     def squaresamples(self, numsecs, bytespersamp=2, sampfreq=44100,
-                      fadein=0, fadeout=0) -> bytes:
+                      fadein=0, fadeout=0, start=0, numsamps=None) -> bytes:
         """Get audio samples from the wave's attributes using a sine function
         
         Default parameters use standard audio quality.
         :param numsecs: The number of seconds to generate
-        :param bytespersamp: The bit-depth of one sample
+        :param bytespersamp: The depth of one sample in bytes (3 for 24-bit)
         :param sampfreq: The sample frequency (in Hz)
         :param fadein: How many seconds to fade in for
         :param fadeout: How many seconds to fade out for
+        :param start: The first sample to generate, for generating the sound
+        in blocks
+        :param numsamps: How many samples to generate (up to the end of the
+        sound by default)
         :return: The audio samples as a bytes object
         :rtype: bytes
         """
@@ -91,44 +87,190 @@ class Wave:
         # Wave period
         period = 1 / self.freq
         
-        # Initialize return samples as a bytes object
-        numsamps = int(numsecs * sampfreq)
-        samples = bytearray(numsamps * bytespersamp)
-        
-        # Index in samples bytearray
-        s = 0
-        
-        for i in range(numsamps):
-            # Get x-value
-            x = i / sampfreq
-            
-            fademult = 1.0
-            # Fade in
-            if x < fadein:
-                # [0.0, 1.0] over the course of fade in time
-                fademult = x / fadein
-            
-            # Fade out
-            if (numsecs - x) < fadeout:
-                # [1.0, 0.0] over the course of fade out time
-                fademult = (numsecs - x) / fadeout
-            
-            # Value of square wave function [minvolume, maxvolume]
-            pos_in_period = (x + self.offset) / period
-            if pos_in_period % 1 < 0.5:
-                # [0, 0.5) in period length
-                squarevalue = int(self.axis - 0.5 * self.amplitude * fademult)
-            else:
-                # [0.5, 1) in period length
-                squarevalue = int(self.axis + 0.5 * self.amplitude * fademult)
-            
-            # Push to samples
-            samplebytes = twoscompbytes(squarevalue, bytespersamp)
-            for byte in samplebytes:
-                samples[s] = byte
-                s += 1
-        
-        return bytes(samples)
+        # Time of each sample (seconds) and its fade multiplier
+        x = sampletimes(numsecs, sampfreq, start, numsamps)
+        fademult = fademults(x, numsecs, fadein, fadeout)
+        
+        # Value of square wave function [minvolume, maxvolume]
+        pos_in_period = (x + self.offset) / period
+        halfheight = 0.5 * self.amplitude * fademult
+        squarevalue = np.where(pos_in_period % 1 < 0.5,
+                               self.axis - halfheight,
+                               self.axis + halfheight)
+        
+        # Truncate like int()
+        return arraytopcm(np.trunc(squarevalue), bytespersamp)
+    
+    def tablesamples(self, numsecs, bytespersamp=2, sampfreq=44100,
+                     fadein=0, fadeout=0, start=0, numsamps=None,
+                     waveform='sine') -> bytes:
+        """Get audio samples from the wave's attributes using a wavetable
+        
+        Like sinesamples or squaresamples, but looking each sample up in a
+        cached table of one cycle of the wave, interpolating between points,
+        instead of computing the wave function for it.
+        :param numsecs: The number of seconds to generate
+        :param bytespersamp: The depth of one sample in bytes (3 for 24-bit)
+        :param sampfreq: The sample frequency (in Hz)
+        :param fadein: How many seconds to fade in for
+        :param fadeout: How many seconds to fade out for
+        :param start: The first sample to generate, for generating the sound
+        in blocks
+        :param numsamps: How many samples to generate (up to the end of the
+        sound by default)
+        :param waveform: The shape of the wave (see WAVEFORMS)
+        :return: The audio samples as a bytes object
+        :rtype: bytes
+        """
+        
+        # Time of each sample (seconds) and its fade multiplier
+        x = sampletimes(numsecs, sampfreq, start, numsamps)
+        fademult = fademults(x, numsecs, fadein, fadeout)
+        
+        # Phase [0, 1) of each sample within a cycle of the wave (sine waves
+        # start at the offset, square waves before it)
+        if waveform == 'sine':
+            phases = self.freq * (x - self.offset)
+        else:
+            phases = self.freq * (x + self.offset)
+        phases %= 1
+        
+        # Interpolate between the points of the table either side
+        table, slopes = wavetable(waveform)
+        phases *= len(slopes)
+        index = phases.astype(np.intp)
+        phases -= index
+        
+        # A tiny negative phase wraps to exactly 1.0, one past the last point
+        index %= len(slopes)
+        phases *= slopes[index]
+        value = phases
+        value += table[index]
+        
+        # Value of the wave [0, 1], mapped to [-minvolume, maxvolume]
+        wavevalue = fademult * value / 2 + 0.5
+        sampvolume = np.trunc(self.minvolume + self.amplitude * wavevalue)
+        return arraytopcm(sampvolume, bytespersamp)
+
+
+@lru_cache(maxsize=WAVETABLE_CACHE)
+def wavetable(waveform, size=WAVETABLE_SIZE):
+    """Gets one cycle of a wave as a table of points, computed once
+    
+    :param waveform: The shape of the wave (see WAVEFORMS)
+    :param size: How many points to split the cycle into
+    :return: Read-only NumPy arrays of the wave [-1, 1] at each point and of
+    the change from each point to the next (wrapping around at the end)
+    """
+    
+    phase = np.arange(size + 1) / size
+    if waveform == 'sine':
+        points = np.sin(2 * pi * phase)
+    elif waveform == 'square':
+        # Low for the first half of the cycle, like squaresamples
+        points = np.where(phase % 1 < 0.5, -1.0, 1.0)
+    else:
+        raise ValueError('Unknown waveform: ' + str(waveform))
+    
+    table = points[:-1]
+    slopes = np.diff(points)
+    table.flags.writeable = False
+    slopes.flags.writeable = False
+    return table, slopes
+
+
+def sampletimes(numsecs, sampfreq, start=0, numsamps=None):
+    """Gets the time of each sample in a block of a sound
+    
+    Times are counted from the start of the whole sound, so blocks generated
+    one after another join up exactly.
+    
+    :param numsecs: The length of the whole sound (in seconds)
+    :param sampfreq: The sample frequency (in Hz)
+    :param start: The first sample of the block
+    :param numsamps: How many samples are in the block (up to the end of the
+    sound by default)
+    :return: The time of each sample (in seconds) as a NumPy array
+    """
+    
+    if numsamps is None:
+        numsamps = int(numsecs * sampfreq) - start
+    
+    return (start + np.arange(max(numsamps, 0))) / sampfreq
+
+
+def fademults(x, numsecs, fadein=0, fadeout=0):
+    """Gets the volume multiplier of each sample for fading in and out
+    
+    :param x: The time of each sample (in seconds) as a NumPy array
+    :param numsecs: The length of the sound (in seconds)
+    :param fadein: How many seconds to fade in for (0 for no fade)
+    :param fadeout: How many seconds to fade out for (0 for no fade)
+    :return: The multiplier of each sample, from 0.0 to 1.0
+    """
+    
+    fademult = np.ones(len(x))
+    
+    # Fade in, [0.0, 1.0] over the course of fade in time
+    if fadein > 0:
+        fading = x < fadein
+        fademult[fading] = x[fading] / fadein
+    
+    # Fade out, [1.0, 0.0] over the course of fade out time
+    if fadeout > 0:
+        remaining = numsecs - x
+        fading = remaining < fadeout
+        fademult[fading] = remaining[fading] / fadeout
+    
+    return fademult
+
+
+def arraytopcm(samples, bytespersamp):
+    """Gets little-endian two's complement PCM bytes from an array of samples
+    
+    Gives the same bytes as twoscompbytes on each sample, for any sample
+    width up to 8 bytes (e.g. 3 for 24-bit audio).
+    
+    :param samples: The integer sample values as a NumPy array
+    :param bytespersamp: The depth of one sample in bytes
+    :return: The audio samples as a bytes object
+    :rtype: bytes
+    """
+    
+    dtype = PCM_TYPES.get(bytespersamp)
+    if dtype is not None:
+        return samples.astype(dtype).tobytes()
+    
+    # Other widths keep the low bytes of each wider sample
+    wide = samples.astype('<i4' if bytespersamp < 4 else '<i8')
+    lowbytes = wide.view(np.uint8).reshape(-1, wide.itemsize)
+    return lowbytes[:, :bytespersamp].tobytes()
+
+
+def pcmtoarray(data, bytespersamp):
+    """Gets the samples of little-endian two's complement PCM bytes as an array
+    
+    1, 2, 4 and 8 byte samples are read in place without copying. Gives the
+    same values as twoscompint on each sample, for any sample width up to 8
+    bytes (e.g. 3 for 24-bit audio).
+    
+    :param data: The audio samples as a bytes-like object
+    :param bytespersamp: The depth of one sample in bytes
+    :return: The signed sample values as a NumPy array
+    """
+    
+    dtype = PCM_TYPES.get(bytespersamp)
+    if dtype is not None:
+        return np.frombuffer(data, dtype)
+    
+    # Other widths go in the high bytes of a wider sample, then shift back
+    # down to sign-extend them
+    widetype = '<i4' if bytespersamp < 4 else '<i8'
+    widebytes = np.dtype(widetype).itemsize
+    raw = np.frombuffer(data, np.uint8).reshape(-1, bytespersamp)
+    wide = np.zeros((len(raw), widebytes), dtype=np.uint8)
+    wide[:, widebytes - bytespersamp:] = raw
+    return wide.view(widetype)[:, 0] >> (8 * (widebytes - bytespersamp))
 
 
 def twoscompbytes(x, numbytes):
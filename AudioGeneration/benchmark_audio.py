@@ -0,0 +1,145 @@
+# Author
+# William Lucca
+
+import multiprocessing
+import time
+
+from AudioGeneration import multi_wave_evolution as mwe
+from AudioGeneration.audiowave import Wave, wavetable
+from AudioGeneration.note import Note, getfreq
+
+# Benchmark settings
+CHORD = ['E1', 'E2', 'G#3', 'B4']
+DURATIONS = [mwe.DURATION, 1.0]
+NUM_CHORDS = {mwe.DURATION: 200, 1.0: 20}
+LEGACY_CHORDS = 10
+OSCILLATORS = ['sinesamples', 'tablesamples']
+NOTES = [letter + octave for octave in '2345'
+         for letter in ['C', 'D', 'E', 'F', 'G', 'A', 'B']]
+NUM_NOTES = 10000
+
+
+class NullWav:
+    """Stands in for an open wave file, throwing the frames away"""
+    
+    def __init__(self):
+        self.numbytes = 0
+    
+    def writeframes(self, data):
+        self.numbytes += len(data)
+
+
+def legacy_writechord(outwav, notes, duration):
+    """The original writechord: a new pool of 4 processes for every chord,
+    sending every Wave and its samples through pipes
+    """
+    
+    pool = multiprocessing.Pool(4)
+    waves = [Wave(Note(n).freq, -mwe.MAX_VOLUME, mwe.MAX_VOLUME)
+             for n in notes]
+    fade = mwe.FADE_PERCENT * duration
+    results = [pool.apply_async(w.sinesamples,
+                                args=(duration, mwe.SAMP_WIDTH,
+                                      mwe.FRAMERATE, fade, fade))
+               for w in waves]
+    mixed = mwe.mixsamples(mwe.SAMP_WIDTH, [r.get() for r in results])
+    pool.close()
+    pool.join()
+    outwav.writeframes(mixed)
+
+
+def chords_per_second(write, numchords, duration):
+    """Time writing chords one call at a time
+    
+    :param write: Function writing one chord, like writechord
+    :param numchords: How many chords to write
+    :param duration: How many seconds each chord lasts
+    :return: The number of chords written per second
+    """
+    
+    outwav = NullWav()
+    start = time.perf_counter()
+    for i in range(numchords):
+        write(outwav, CHORD, duration)
+    return numchords / (time.perf_counter() - start)
+
+
+def batched_chords_per_second(numchords, duration):
+    """Time writing chords all in one writechords call
+    
+    :param numchords: How many chords to write
+    :param duration: How many seconds each chord lasts
+    :return: The number of chords written per second
+    """
+    
+    outwav = NullWav()
+    start = time.perf_counter()
+    mwe.writechords(outwav, [CHORD] * numchords, duration)
+    return numchords / (time.perf_counter() - start)
+
+
+def compare_executors():
+    """Compare chords per second of the old and new ways of rendering, for
+    short and long chords
+    """
+    
+    # Start the shared executor's workers before timing
+    mwe.getexecutor().getpool()
+    
+    print('%-10s %16s %16s %16s' % ('duration', 'pool per chord',
+                                    'executor', 'batched'))
+    for duration in DURATIONS:
+        legacy = chords_per_second(legacy_writechord, LEGACY_CHORDS,
+                                   duration)
+        single = chords_per_second(mwe.writechord, NUM_CHORDS[duration],
+                                   duration)
+        batched = batched_chords_per_second(NUM_CHORDS[duration], duration)
+        print('%-10s %16.1f %16.1f %16.1f' % ('%gs' % duration, legacy,
+                                              single, batched))
+
+
+def notes_per_second(oscillator, numnotes, duration):
+    """Time rendering a sequence of short notes one after another
+    
+    :param oscillator: The name of the Wave method making the samples
+    :param numnotes: How many notes to render
+    :param duration: How many seconds each note lasts
+    :return: The number of notes rendered per second
+    """
+    
+    fade = mwe.FADE_PERCENT * duration
+    start = time.perf_counter()
+    for i in range(numnotes):
+        w = Wave(Note(NOTES[i % len(NOTES)]).freq, -mwe.MAX_VOLUME,
+                 mwe.MAX_VOLUME)
+        getattr(w, oscillator)(duration, mwe.SAMP_WIDTH, mwe.FRAMERATE, fade,
+                               fade)
+    return numnotes / (time.perf_counter() - start)
+
+
+def compare_oscillators():
+    """Compare notes per second of each oscillator on a long sequence of
+    short notes, and how often the caches were hit
+    """
+    
+    print('%-14s %16s' % ('oscillator', 'notes per second'))
+    for oscillator in OSCILLATORS:
+        rate = notes_per_second(oscillator, NUM_NOTES, mwe.DURATION)
+        print('%-14s %16.1f' % (oscillator, rate))
+    
+    print('\nwavetable: ' + str(wavetable.cache_info()))
+    print('getfreq:   ' + str(getfreq.cache_info()))
+
+
+def main():
+    """Run every benchmark
+    """
+    
+    print('%d workers, %d notes per chord\n' % (mwe.WORKERS, len(CHORD)))
+    compare_executors()
+    print()
+    compare_oscillators()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 # Author
 # William Lucca
 
+import atexit
+import os
+import sys
 import wave
 import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
 from AudioGeneration.audiowave import *
 from AudioGeneration.note import *
 from AudioGeneration.waveviewer import readwav
@@ -21,6 +27,23 @@ MAX_VOLUME = (256 ** (BIT_DEPTH // 8)) / 2 - 1
 DURATION = 0.05
 FADE_PERCENT = 0.0
 
+# Wave method making each note's samples: 'sinesamples' computes the sine
+# of every sample, 'tablesamples' looks them up in a cached wavetable
+OSCILLATOR = 'sinesamples'
+
+# Render settings (see RenderExecutor)
+WORKERS = os.cpu_count() or 1  # Worker processes for rendering waves
+INLINE_SAMPLES = 2 ** 16  # Renders smaller than this are done in-process
+
+# Samples per block when streaming (see streamchord)
+BLOCK_SIZE = 44100
+
+# Mixing settings (see mixsamples)
+MIX_MODES = ['average', 'sum', 'normalize']
+MIX_LENGTHS = ['pad', 'truncate']
+MIX_MODE = 'average'
+MIX_LENGTH = 'pad'
+
 
 def writechordtofile(filename, chord):
     """Initializes an audio file and writes a chord of audio waves
@@ -36,81 +59,311 @@ def writechordtofile(filename, chord):
         writechord(outwav, chord, DURATION)
 
 
-def writechord(outwav, notes, duration):
-    # Create pool of worker processes for generating digital audio samples
-    pool = multiprocessing.Pool(4)
+def streamchordtofile(filename, chord, duration=DURATION):
+    """Streams a chord of audio waves to an audio file block by block
+    
+    :param filename: The wav file to write, or '-' to write raw PCM samples
+    to stdout
+    :param chord: The names of the notes in the chord
+    :param duration: How many seconds to play the chord for
+    """
+    
+    if filename == '-':
+        streamchord(sys.stdout.buffer, chord, duration)
+        sys.stdout.buffer.flush()
+        return
+    
+    with wave.open(filename, 'wb') as outwav:
+        # Setup audio file parameters
+        outwav.setsampwidth(SAMP_WIDTH)
+        outwav.setframerate(FRAMERATE)
+        outwav.setnchannels(NUM_CHANNELS)
+        
+        # Stream a chord
+        streamchord(outwav, chord, duration)
+
+
+def streamchord(out, notes, duration, blocksize=BLOCK_SIZE):
+    """Generates, mixes and writes a chord one block of samples at a time
+    
+    Each block of each wave is generated at its position in the whole
+    chord, so the blocks join up exactly and the output is the same as
+    generating everything at once. Only one block is held in memory, so any
+    duration takes the same memory.
+    
+    The 'normalize' mix mode scales every block separately, so use another
+    MIX_MODE when streaming.
+    
+    :param out: An open wave file (written with writeframes) or a binary
+    file (written with write), like sys.stdout.buffer for raw PCM
+    :param notes: The names of the notes in the chord
+    :param duration: How many seconds to play the chord for
+    :param blocksize: How many samples to generate at a time
+    """
+    
+    if hasattr(out, 'writeframes'):
+        write = out.writeframes
+    else:
+        write = out.write
     
     # Make some audio wave objects
     waves = []
     for n in notes:
         waves.append(Wave(Note(n).freq, -MAX_VOLUME, MAX_VOLUME))
     
-    # Get their digital audio samples (expensive!)
-    results = []
     fade = FADE_PERCENT * duration
-    for w in waves:
-        results.append(pool.apply_async(
-                w.sinesamples,
-                args=(duration, SAMP_WIDTH, FRAMERATE, fade, fade)
-        ))
+    numsamps = int(duration * FRAMERATE)
+    for start in range(0, numsamps, blocksize):
+        # Generate and mix just this block of each wave
+        count = min(blocksize, numsamps - start)
+        blocks = []
+        for w in waves:
+            oscillator = getattr(w, OSCILLATOR)
+            blocks.append(oscillator(duration, SAMP_WIDTH, FRAMERATE, fade,
+                                     fade, start, count))
+        write(mixsamples(SAMP_WIDTH, blocks))
+
+
+# The shared render executor (see getexecutor)
+executor = None
+
+
+class RenderExecutor:
+    """A long-lived pool of worker processes for rendering waves
+    
+    The pool is started on the first render too big to do in this process,
+    then reused for every render after that. Each task renders
+    a batch of waves, sending only their parameters, and writes the samples
+    straight into one shared memory block instead of sending them back.
+    Renders too small to be worth the trip to another process are done in
+    this one.
+    """
+    
+    def __init__(self, workers=None):
+        """Creates a RenderExecutor, without starting its worker processes
+        
+        :param workers: How many worker processes to use (WORKERS by default)
+        """
+        
+        if workers is None:
+            workers = WORKERS
+        
+        self.workers = workers
+        self.pool = None
+    
+    def getpool(self):
+        """Gets the pool of worker processes, starting it on first use
+        """
+        
+        if self.pool is None:
+            # Workers share this process's tracker of shared memory blocks,
+            # so blocks they open aren't cleaned up again when they exit
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool
+    
+    def renderchords(self, chords, duration, fade=0.0):
+        """Renders and mixes many chords of sine waves at once
+        
+        Every note of every chord is rendered in one go, in batches spread
+        over the workers, so many short chords cost about as much as one
+        long one.
+        
+        :param chords: A list of chords, each a list of note names
+        :param duration: How many seconds to play each chord for
+        :param fade: How many seconds to fade each chord in and out for
+        :return: The mixed audio samples of each chord as bytes objects
+        """
+        
+        # Parameters of each wave and of the samples
+        items = []
+        for chord in chords:
+            for n in chord:
+                items.append((Note(n).freq, -MAX_VOLUME, MAX_VOLUME))
+        params = (duration, SAMP_WIDTH, FRAMERATE, fade, fade)
+        slotsize = int(duration * FRAMERATE) * SAMP_WIDTH
+        
+        # Small renders aren't worth sending to other processes
+        if len(items) * slotsize < INLINE_SAMPLES * SAMP_WIDTH:
+            sounds = [getattr(Wave(*item), OSCILLATOR)(*params)
+                      for item in items]
+            return mixchords(chords, sounds)
+        
+        block = shared_memory.SharedMemory(create=True,
+                                           size=len(items) * slotsize)
+        try:
+            # One batch of waves per worker
+            batchsize = -(-len(items) // self.workers)
+            tasks = []
+            for first in range(0, len(items), batchsize):
+                tasks.append((block.name, slotsize, first,
+                              items[first:first + batchsize], OSCILLATOR,
+                              params))
+            self.getpool().map(renderbatch, tasks)
+            
+            # Mix straight from the shared memory
+            sounds = [block.buf[i * slotsize:(i + 1) * slotsize]
+                      for i in range(len(items))]
+            mixed = mixchords(chords, sounds)
+            for sound in sounds:
+                sound.release()
+        finally:
+            block.close()
+            block.unlink()
+        
+        return mixed
+    
+    def close(self):
+        """Stops the worker processes, if they were started
+        """
+        
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
     
-    # Retrieve samples from pool's results objects
-    generatedsounds = []
-    for r in results:
-        audio = r.get()
-        generatedsounds.append(audio)
+    def __enter__(self):
+        return self
     
-    # Mix all of the generated waves
-    mixed = mixsamples(SAMP_WIDTH, generatedsounds)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def renderbatch(task):
+    """Renders a batch of waves into shared memory (in a worker process)
     
-    # Clean up pool processes
-    pool.close()
-    pool.join()
+    :param task: The shared memory block's name, the size of each wave's
+    slot in it, the first slot to fill, the parameters of each Wave, and
+    the name of the Wave method making the samples and its parameters
+    """
+    
+    name, slotsize, first, items, oscillator, params = task
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        for i in range(len(items)):
+            slot = first + i
+            block.buf[slot * slotsize:(slot + 1) * slotsize] = \
+                getattr(Wave(*items[i]), oscillator)(*params)
+    finally:
+        block.close()
+
+
+def mixchords(chords, sounds):
+    """Mixes rendered waves back into their chords
+    
+    :param chords: A list of chords, each a list of note names
+    :param sounds: The samples of every note of every chord, in order
+    :return: The mixed audio samples of each chord as bytes objects
+    """
+    
+    mixed = []
+    first = 0
+    for chord in chords:
+        mixed.append(mixsamples(SAMP_WIDTH, sounds[first:first + len(chord)]))
+        first += len(chord)
+    return mixed
+
+
+def getexecutor():
+    """Gets the shared render executor, creating it on first use
+    
+    The executor is closed when the program exits.
+    """
+    
+    global executor
+    
+    if executor is None:
+        executor = RenderExecutor()
+        atexit.register(executor.close)
+    return executor
+
+
+def writechord(outwav, notes, duration):
+    # Render with the shared worker processes
+    fade = FADE_PERCENT * duration
+    mixed = getexecutor().renderchords([notes], duration, fade)[0]
     
     # Write to wav file
     outwav.writeframes(mixed)
 
 
-def mixsamples(bytespersamp, waves):
+def writechords(outwav, chords, duration):
+    """Writes many chords one after another, rendering them all at once
+    
+    :param outwav: The open wave file to write to
+    :param chords: A list of chords, each a list of note names
+    :param duration: How many seconds to play each chord for
+    """
+    
+    fade = FADE_PERCENT * duration
+    for mixed in getexecutor().renderchords(chords, duration, fade):
+        outwav.writeframes(mixed)
+
+
+def mixsamples(bytespersamp, waves, gains=None, mode=MIX_MODE,
+               length=MIX_LENGTH):
     """Mixes multiple waves together to produce a composite wave
     
+    Samples are summed as 64-bit integers (or as floats, with gains), so
+    nothing overflows before the mix mode brings them back into range.
+    
     :param bytespersamp: The depth of one sample in bytes
     :param waves: All of the sample bytes objects
+    :param gains: The volume multiplier of each wave (all 1 by default)
+    :param mode: How to bring the sum back into range (see MIX_MODES):
+    'average' divides by the number of waves, 'sum' clips to the sample
+    range and 'normalize' scales the loudest sample to full volume
+    :param length: How to handle waves of different lengths (see
+    MIX_LENGTHS): 'pad' mixes to the longest wave as if the others were
+    followed by silence, 'truncate' cuts every wave to the shortest
     :return: The mixed audio samples as a bytes object
     :rtype: bytes
     """
     
-    # Get length of shortest audio sample list
-    shortestlen = -1
-    for w in waves:
-        if len(w) > shortestlen:
-            shortestlen = len(w)
+    if mode not in MIX_MODES:
+        raise ValueError('Unknown mix mode: ' + str(mode))
+    if length not in MIX_LENGTHS:
+        raise ValueError('Unknown mix length: ' + str(length))
+    if len(waves) == 0:
+        return b''
     
-    finalsamples = bytearray(shortestlen)
-    numwaves = len(waves)
+    # Read every wave's samples in place
+    tracks = [pcmtoarray(w, bytespersamp) for w in waves]
+    if length == 'pad':
+        numsamps = max(len(t) for t in tracks)
+    else:
+        numsamps = min(len(t) for t in tracks)
     
-    # Index in finalsamples bytearray
-    s = 0
+    if gains is None:
+        # Sum the samples
+        total = np.zeros(numsamps, dtype=np.int64)
+        for track in tracks:
+            track = track[:numsamps]
+            total[:len(track)] += track
+    else:
+        # Sum the scaled samples as floats, which are exact for integers
+        # far past any sum of samples, and round once at the end
+        scaled = np.zeros(numsamps)
+        scratch = np.empty(numsamps)
+        for track, gain in zip(tracks, gains):
+            track = track[:numsamps]
+            product = scratch[:len(track)]
+            np.multiply(track, gain, out=product)
+            scaled[:len(track)] += product
+        total = np.rint(scaled).astype(np.int64)
     
-    # Average the individual samples of each wave one at a time
-    for i in range(0, shortestlen, bytespersamp):
-        # Cumulative sum for this wave
-        total = 0
-        for w in waves:
-            # Get signed integer value of sample and add to sum
-            sample = w[i: i + bytespersamp]
-            total += twoscompint(sample, bytespersamp)
-        
-        # Convert average into two's complement
-        average = total // numwaves
-        average = twoscompbytes(average, bytespersamp)
-        
-        # Push average onto finalsamples
-        for byte in average:
-            finalsamples[s] = byte
-            s += 1
+    # Bring the sum back into the sample range
+    maxsample = 2 ** (8 * bytespersamp - 1) - 1
+    if mode == 'average':
+        total //= len(tracks)
+    elif mode == 'sum':
+        np.clip(total, -maxsample - 1, maxsample, out=total)
+    else:
+        peak = np.abs(total).max() if numsamps > 0 else 0
+        if peak > 0:
+            total = np.trunc(total * (maxsample / peak))
     
-    return bytes(finalsamples)
+    return arraytopcm(total, bytespersamp)
 
 
 if __name__ == '__main__':
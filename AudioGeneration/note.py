@@ -2,6 +2,7 @@
 # William Lucca
 
 import re
+from functools import lru_cache
 
 
 class Note:
@@ -18,6 +19,7 @@ class Note:
         self.freq = getfreq(self.pianonum)
 
 
+@lru_cache(maxsize=None)
 def getpianonum(name):
     """Get the numerical position of this note on a piano (1 is A0)
     
@@ -65,6 +67,7 @@ def getpianonum(name):
     return letter + semitone + octave
 
 
+@lru_cache(maxsize=None)
 def getfreq(pianonum):
     """Calculates the frequency of a given note on a standard piano
     
@@ -0,0 +1,349 @@
+# Author
+# William Lucca
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import markov_images
+from markov_data import MarkovData, get_color_tuple
+from PIL import Image
+
+# Command line options
+OPTIONS = ['-h', '-o', '-c']
+
+# Benchmark settings
+IMAGES = ['test1.jpg', 'rainbow.jpg']
+SIZES = [100, 300, 600]
+NUM_PAIRS = 100000
+NUM_SAMPLES = 100000
+PROFILE_LIMIT = 10
+CHECK_PROCESSES = [1, 2]
+REPORT_LIMIT = 3
+DEFAULT_OUT_PATH = 'benchmark_images.json'
+
+
+class StageProfiler:
+    """Measures consecutive stages of a run
+    
+    Each stage is timed, traced with tracemalloc for its peak memory and
+    profiled with cProfile, so the timings include the profiling overhead.
+    """
+    
+    def __init__(self, limit=PROFILE_LIMIT):
+        """Creates a StageProfiler
+        
+        :param limit: How many of the slowest functions to keep per stage
+        """
+        
+        self.limit = limit
+        self.results = []
+        self.name = ''
+        self.profiler = None
+        self.start_time = 0
+    
+    def start(self, name):
+        """Start measuring a stage
+        
+        :param name: The name of the stage
+        """
+        
+        self.name = name
+        self.profiler = cProfile.Profile()
+        tracemalloc.start()
+        self.start_time = time.perf_counter()
+        self.profiler.enable()
+    
+    def stop(self, amount):
+        """Stop measuring the current stage and record its results
+        
+        :param amount: How many items (pixels, pairs, samples) the stage
+        processed, for its rate
+        :return: The stage's result dict
+        """
+        
+        self.profiler.disable()
+        seconds = time.perf_counter() - self.start_time
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        result = {
+            'stage': self.name,
+            'amount': amount,
+            'seconds': seconds,
+            'per_second': amount / seconds if seconds > 0 else 0,
+            'peak_kb': peak / 1024,
+            'functions': top_functions(self.profiler, self.limit)
+        }
+        self.results.append(result)
+        return result
+
+
+def top_functions(profiler, limit=PROFILE_LIMIT):
+    """Get the functions a profile spent the most time in
+    
+    :param profiler: The finished cProfile.Profile
+    :param limit: How many functions to keep
+    :return: A list of dicts of each function's name, call count, own time
+    and cumulative time, slowest first
+    """
+    
+    rows = []
+    for (path, line, name), (primitive_calls, calls, own_time, total_time,
+                             callers) in pstats.Stats(profiler).stats.items():
+        rows.append({
+            'function': '%s:%d(%s)' % (os.path.basename(path), line, name),
+            'calls': calls,
+            'tottime': own_time,
+            'cumtime': total_time
+        })
+    
+    rows.sort(key=lambda row: row['tottime'], reverse=True)
+    return rows[:limit]
+
+
+def measure_stage(name, run, amount, label=''):
+    """Benchmark one stage: a clean timed run, then a profiled run
+    
+    :param name: The name of the stage
+    :param run: Function running the stage from scratch
+    :param amount: How many items the stage processes
+    :param label: What the stage ran on, like the image name
+    :return: The stage's result dict, with the clean run's timing
+    """
+    
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    
+    profiler = StageProfiler()
+    profiler.start(name)
+    run()
+    result = profiler.stop(amount)
+    
+    result['label'] = label
+    result['profiled_seconds'] = result['seconds']
+    result['seconds'] = seconds
+    result['per_second'] = amount / seconds if seconds > 0 else 0
+    return result
+
+
+def count_pixels(paths):
+    """Get the total number of pixels in some image files"""
+    
+    total = 0
+    for path in paths:
+        with Image.open(path) as image:
+            total += image.width * image.height
+    return total
+
+
+def analyze(path):
+    """Train a fresh MarkovData on one image"""
+    
+    markov_images.markov_data = MarkovData()
+    markov_images.analyze_image(path)
+    return markov_images.markov_data
+
+
+def benchmark_image(path):
+    """Benchmark every stage of the pipeline on one image
+    
+    :param path: The image file to train on
+    :return: A list of stage result dicts
+    """
+    
+    results = []
+    label = os.path.basename(path)
+    
+    results.append(measure_stage('analyze_image', lambda: analyze(path),
+                                 count_pixels([path]), label))
+    markov = analyze(path)
+    
+    # The image's own pairs, repeated up to NUM_PAIRS
+    keys, counts = markov_images.count_image_pairs(path)
+    keys = keys.tolist()
+    pairs = [(get_color_tuple(keys[i % len(keys)] >> 32),
+              get_color_tuple(keys[i % len(keys)] & 0xFFFFFFFF))
+             for i in range(NUM_PAIRS)]
+    
+    def record_pairs():
+        pair_data = MarkovData()
+        for color1, color2 in pairs:
+            pair_data.record_pair(color1, color2)
+    
+    results.append(measure_stage('record_pair', record_pairs, NUM_PAIRS,
+                                 label))
+    
+    results.append(measure_stage('finalize', markov.finalize,
+                                 len(markov.data), label))
+    
+    firsts = list(markov.data)
+    
+    def next_colors():
+        random.seed(0)
+        for i in range(NUM_SAMPLES):
+            markov.next_color(firsts[i % len(firsts)])
+    
+    def random_colors():
+        random.seed(0)
+        for i in range(NUM_SAMPLES):
+            markov.random_color()
+    
+    results.append(measure_stage('next_color', next_colors, NUM_SAMPLES,
+                                 label))
+    results.append(measure_stage('random_color', random_colors, NUM_SAMPLES,
+                                 label))
+    
+    for size in SIZES:
+        generator = markov_images.ImageGenerator(markov, size, size, 0)
+        results.append(measure_stage('create_image %dx%d' % (size, size),
+                                     generator.create_image, size * size,
+                                     label))
+    
+    return results
+
+
+def model_bytes(markov):
+    """Get the bytes of the model file a MarkovData saves"""
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.bin')
+        markov.save(path)
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+
+def check_analysis(paths, processes_list=CHECK_PROCESSES):
+    """Check that analyzing images together gives the same model file as
+    analyzing them one at a time
+    
+    :param paths: The image files to analyze
+    :param processes_list: The numbers of processes to analyze them with
+    :return: True if every model file matched
+    """
+    
+    markov_images.markov_data = MarkovData()
+    for path in paths:
+        markov_images.analyze_image(path)
+    expected = model_bytes(markov_images.markov_data)
+    
+    matched = True
+    for processes in processes_list:
+        markov_images.markov_data = MarkovData()
+        markov_images.analyze_images(paths, processes=processes)
+        same = model_bytes(markov_images.markov_data) == expected
+        print('analyze_images with %d process(es) %s analyze_image per image'
+              % (processes, 'matches' if same else 'DIFFERS from'))
+        matched = matched and same
+    return matched
+
+
+def print_report(results, limit=REPORT_LIMIT):
+    """Print a table of stage results and their slowest functions
+    
+    :param results: Stage result dicts
+    :param limit: How many functions to print per stage
+    """
+    
+    print('%-14s %-22s %10s %14s %12s' % ('', 'stage', 'seconds', 'per second',
+                                          'peak (KB)'))
+    for result in results:
+        print('%-14s %-22s %10.3f %14.0f %12.0f'
+              % (result.get('label', ''), result['stage'], result['seconds'],
+                 result['per_second'], result['peak_kb']))
+        for function in result['functions'][:limit]:
+            print('%-14s   %-50s %8.3f' % ('', function['function'],
+                                           function['tottime']))
+
+
+def print_comparison(results, old_results):
+    """Print how much faster each stage is than in an earlier run
+    
+    :param results: This run's stage result dicts
+    :param old_results: An earlier run's stage result dicts
+    """
+    
+    old = {(result['label'], result['stage']): result
+           for result in old_results}
+    
+    print('%-14s %-22s %14s %14s %8s' % ('', 'stage', 'per second',
+                                         'before', 'speedup'))
+    for result in results:
+        before = old.get((result['label'], result['stage']))
+        if before is None or before['per_second'] == 0:
+            continue
+        print('%-14s %-22s %14.0f %14.0f %7.2fx'
+              % (result['label'], result['stage'], result['per_second'],
+                 before['per_second'],
+                 result['per_second'] / before['per_second']))
+
+
+def printhelp():
+    # Print basic usage
+    print('\nUsage:  benchmark_images.py [-h] [-o FILE] [-c FILE]\n')
+    
+    # Print description of each option
+    print('[' + OPTIONS[0] + ']\t\tDisplay this help message')
+    print('[' + OPTIONS[1] + ' FILE]\tWrite the results to a given JSON file '
+                             '(default "' + DEFAULT_OUT_PATH + '")')
+    print('[' + OPTIONS[2] + ' FILE]\tCompare with the results of an earlier '
+                             'run')
+
+
+def main():
+    """Benchmark the pipeline on the bundled images and save the results
+    """
+    
+    out_path = DEFAULT_OUT_PATH
+    compare_path = ''
+    
+    # Iterate over command line arguments
+    argv = ''
+    for i in range(1, len(sys.argv)):
+        # Get argument and potential option flag
+        prev = argv
+        argv = sys.argv[i]
+        
+        if argv == '-h':
+            # Display usage information
+            printhelp()
+            exit(0)
+        elif argv in OPTIONS:
+            continue
+        elif prev == '-o':
+            # Set the output filepath
+            out_path = argv
+        elif prev == '-c':
+            # Set the filepath of the results to compare with
+            compare_path = argv
+    
+    if not check_analysis(IMAGES):
+        print('Parallel analysis gave a different model.')
+        exit(1)
+    print()
+    
+    results = []
+    for path in IMAGES:
+        results.extend(benchmark_image(path))
+    print_report(results)
+    
+    with open(out_path, 'w') as fp:
+        json.dump({'python': sys.version, 'results': results}, fp, indent=2)
+    print('\nResults written to "' + out_path + '".')
+    
+    if compare_path:
+        with open(compare_path) as fp:
+            old_results = json.load(fp)['results']
+        print()
+        print_comparison(results, old_results)
+
+
+if __name__ == '__main__':
+    main()
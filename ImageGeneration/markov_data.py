@@ -1,7 +1,26 @@
 # Author
 # William Lucca
 
+import mmap
+import pickle
 import random
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+# Binary model file layout: magic, version, whether the count tables are
+# 64-bit, then the pair count and the section sizes
+FILE_MAGIC = b'MKVC'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sII4x4Q')
+
+# Typecodes of the sampling tables, in order, when counts fit in 32 bits and
+# when they don't
+TABLE_TYPES = ['I', 'I', 'I', 'I', 'I', 'Q']
+WIDE_TABLE_TYPES = ['I', 'Q', 'I', 'Q', 'I', 'Q']
 
 
 class MarkovData:
@@ -10,58 +29,382 @@ class MarkovData:
         self.num_pairs = 0
         self.first_color_count = dict()
         self.data = dict()
+        
+        # Sampling tables built from data on demand, None when out of date
+        self.tables = None
+        
+        # Memory map backing the tables of a loaded model
+        self.mapped = None
 
     def record_pair(self, color1, color2):
         """Add a single pixel color pair to the markov pairs data"""
     
         # Keep track of how many data points have been added
+        self.unpack()
         self.num_pairs += 1
+        self.tables = None
     
         # Use RGBA mode
-        color1 = getRGBA(color1)
-        color2 = getRGBA(color2)
+        self.add_pair_count(getRGBA(color1), getRGBA(color2), 1)
     
-        # Add pair to dicts
-        if color1 not in self.data:
-            self.data[color1] = {color2: 1}
-            self.first_color_count[color1] = 1
+    def add_pair_count(self, color1, color2, count):
+        """Add to the count of one pair in the dicts, without touching
+        num_pairs or the tables
+        
+        :param color1: The first color, in RGBA
+        :param color2: The second color, in RGBA
+        :param count: How many times the pair was seen
+        """
+        
+        seconds = self.data.get(color1)
+        if seconds is None:
+            self.data[color1] = {color2: count}
+            self.first_color_count[color1] = count
         else:
-            self.first_color_count[color1] += 1
-            if color2 not in self.data[color1]:
-                self.data[color1][color2] = 1
-            else:
-                self.data[color1][color2] += 1
+            self.first_color_count[color1] += count
+            seconds[color2] = seconds.get(color2, 0) + count
 
+    def record_pair_counts(self, keys, counts):
+        """Add many counted pixel color pairs to the markov pairs data
+        
+        Recording the pairs in the order they first appeared gives the same
+        data as calling record_pair for every one of them.
+        
+        :param keys: Each pair as (get_color_int(color1) << 32) |
+        get_color_int(color2), with both colors in RGBA
+        :param counts: How many times each pair was seen
+        """
+        
+        self.unpack()
+        for key, count in zip(keys, counts):
+            self.add_pair_count(get_color_tuple(key >> 32),
+                                get_color_tuple(key & 0xFFFFFFFF), count)
+            self.num_pairs += count
+        
+        self.tables = None
+    
+    def record_pair_arrays(self, keys, counts):
+        """Add many counted pixel color pairs, building the sampling tables
+        straight from the arrays with NumPy
+        
+        Like a loaded model, no dicts are filled in; unpack() rebuilds them
+        if something needs them later. The tables are byte for byte the ones
+        finalize() builds from the same pairs recorded any other way.
+        
+        :param keys: A NumPy array of pairs packed like record_pair_counts
+        takes, in any order and possibly repeated
+        :param counts: A NumPy array of how many times each pair was seen
+        """
+        
+        keys = np.asarray(keys, dtype=np.uint64)
+        counts = np.asarray(counts, dtype=np.int64)
+        if self.num_pairs > 0:
+            old_keys, old_counts = self.pair_count_arrays()
+            keys = np.concatenate([old_keys, keys])
+            counts = np.concatenate([old_counts, counts])
+        if len(keys) == 0:
+            return
+        
+        # Sum the counts of each distinct pair, sorted by pair, which groups
+        # them by first color
+        keys, counts = sum_sorted_counts(keys, counts)
+        
+        self.num_pairs = int(counts.sum())
+        self.tables = tables_from_pair_counts(keys, counts, self.num_pairs)
+        self.data = None
+        self.first_color_count = None
+        self.mapped = None
+    
+    def pair_count_arrays(self):
+        """Get every pair and its count as NumPy arrays, from the tables
+        
+        :return: An array of the pairs, packed like record_pair_counts takes
+        and grouped by first color, and an array of their counts
+        """
+        
+        colors, offsets, successors, cumulative = \
+            [np.asarray(table) for table in self.get_tables()[:4]]
+        row_lengths = np.diff(offsets.astype(np.int64))
+        
+        firsts = np.repeat(colors.astype(np.uint64), row_lengths)
+        keys = (firsts << np.uint64(32)) | successors.astype(np.uint64)
+        
+        # Undo the running totals, which start over at every row
+        cumulative = cumulative.astype(np.int64)
+        counts = np.diff(cumulative, prepend=0)
+        row_starts = offsets[:-1][row_lengths > 0]
+        counts[row_starts] = cumulative[row_starts]
+        return keys, counts
+    
+    def merge(self, other):
+        """Add all of another MarkovData's pairs into this one
+        
+        The result is the same as recording this data's pairs and then
+        other's, in order.
+        
+        :param other: The MarkovData to add
+        """
+        
+        self.unpack()
+        other.unpack()
+        for color1, seconds in other.data.items():
+            for color2, count in seconds.items():
+                self.add_pair_count(color1, color2, count)
+        
+        self.num_pairs += other.num_pairs
+        self.tables = None
+    
+    def finalize(self):
+        """Build the sampling tables from the recorded pairs
+        
+        Colors are packed into ints with get_color_int. The first colors are
+        sorted into colors, and the colors following colors[i] are sorted
+        into successors[offsets[i]:offsets[i + 1]], with running count totals
+        in the matching slice of cumulative. Sorting every row means the same
+        pairs always give the same tables, however they were recorded (see
+        record_pair_arrays). For random_color, every color that
+        was ever second in a pair is in random_colors, with running totals of
+        how often it was second in random_cumulative.
+        
+        Sampling calls this automatically when pairs have been recorded since
+        the tables were last built.
+        """
+        
+        # Counts and offsets only need 64 bits for huge amounts of data
+        types = TABLE_TYPES if self.num_pairs < 2 ** 32 else WIDE_TABLE_TYPES
+        
+        colors = array(types[0])
+        offsets = array(types[1], [0])
+        successors = array(types[2])
+        cumulative = array(types[3])
+        second_counts = dict()
+        
+        for color1 in sorted(self.data, key=get_color_int):
+            colors.append(get_color_int(color1))
+            total = 0
+            seconds = self.data[color1]
+            for color2 in sorted(seconds, key=get_color_int):
+                count = seconds[color2]
+                color2 = get_color_int(color2)
+                total += count
+                successors.append(color2)
+                cumulative.append(total)
+                second_counts[color2] = second_counts.get(color2, 0) + count
+            offsets.append(len(successors))
+        
+        random_colors = array(types[4], sorted(second_counts))
+        random_cumulative = array(types[5])
+        total = 0
+        for color in random_colors:
+            total += second_counts[color]
+            random_cumulative.append(total)
+        
+        self.tables = (colors, offsets, successors, cumulative,
+                       random_colors, random_cumulative)
+    
+    def get_tables(self):
+        """Get the sampling tables, building them first if out of date"""
+        
+        if self.tables is None:
+            self.finalize()
+        return self.tables
+    
+    def random_color_int(self, rng=random):
+        """Pick a color (as an int), weighted by how often it was second in a
+        pair"""
+        
+        random_colors, random_cumulative = self.get_tables()[4:]
+        rand = rng.random() * random_cumulative[-1]
+        return random_colors[bisect_right(random_cumulative, rand)]
+    
+    def next_color_int(self, prev_color, rng=random):
+        """Pick a color (as an int) to follow another, or a random color if
+        nothing ever followed it"""
+        
+        colors, offsets, successors, cumulative = self.get_tables()[:4]
+        
+        # Return random color if no markov data for this prev_color
+        i = bisect_left(colors, prev_color)
+        if i == len(colors) or colors[i] != prev_color:
+            return self.random_color_int(rng)
+        
+        # Pick a random point in the row's total count and bisect for it
+        lo = offsets[i]
+        hi = offsets[i + 1]
+        rand = rng.random() * cumulative[hi - 1]
+        return successors[bisect_right(cumulative, rand, lo, hi)]
+    
+    def contains_int(self, color):
+        """Check if a packed color was ever the first color of a pair"""
+        
+        colors = self.get_tables()[0]
+        i = bisect_left(colors, color)
+        return i < len(colors) and colors[i] == color
+    
+    def color_from_neighbors(self, neighbors, rng=random):
+        """Pick a pixel color given the colors of its neighbors
+        
+        One painted neighbor with markov data is picked at random and the
+        color follows from it, or the color is random if there is none.
+        
+        :param neighbors: The packed colors of the neighbors, -1 for any
+        neighbor that isn't painted
+        :param rng: The random number generator to draw from
+        :return: The packed color
+        """
+        
+        # Consider colors that exist in markov data
+        candidates = [color for color in neighbors
+                      if color >= 0 and self.contains_int(color)]
+        
+        # No markov neighbors returns random color
+        if len(candidates) == 0:
+            return self.random_color_int(rng)
+        
+        # Pick random neighbor color to use data from
+        return self.next_color_int(rng.choice(candidates), rng)
+    
     def random_color(self):
-        # Get random value to select color
-        rand = random.random()
-        cumulative_prob = 0
-        for color2_map in self.data.values():
-            for key in color2_map:
-                cumulative_prob += color2_map[key] / self.num_pairs
-                if rand < cumulative_prob:
-                    return key
+        return get_color_tuple(self.random_color_int())
 
     def next_color(self, prev_color):
-        # Return random color if no markov data for this prev_color
-        if prev_color not in self.data:
-            return self.random_color()
-    
-        # Get random value to select color
-        rand = random.random()
-        cumulative_prob = 0
-        for color in self.data[prev_color]:
-            prob = self.data[prev_color][color] / self.first_color_count[
-                prev_color]
-            cumulative_prob += prob
-            if rand < cumulative_prob:
-                return color
-    
-        # No choices from prev_color, return random
-        return self.random_color()
+        prev_color = get_color_int(getRGBA(prev_color))
+        return get_color_tuple(self.next_color_int(prev_color))
+    
+    def unpack(self):
+        """Rebuild the pair dicts of a loaded model from its tables
+        
+        Loaded models only have their sampling tables until something needs
+        the dicts, like recording more pairs.
+        """
+        
+        if self.data is not None:
+            return
+        
+        colors, offsets, successors, cumulative = self.tables[:4]
+        self.data = dict()
+        self.first_color_count = dict()
+        for i in range(len(colors)):
+            seconds = dict()
+            prev_total = 0
+            for j in range(offsets[i], offsets[i + 1]):
+                seconds[get_color_tuple(successors[j])] = \
+                    cumulative[j] - prev_total
+                prev_total = cumulative[j]
+            
+            color1 = get_color_tuple(colors[i])
+            self.data[color1] = seconds
+            self.first_color_count[color1] = prev_total
+    
+    def save(self, path):
+        """Write the sampling tables to a binary model file
+        
+        The file holds a header followed by each table, little-endian and
+        aligned to 8 bytes, so load() can map them in place.
+        
+        :param path: The file to write
+        """
+        
+        tables = self.get_tables()
+        wide = memoryview(tables[3]).itemsize == 8
+        with open(path, 'wb') as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, wide,
+                                     self.num_pairs, len(tables[0]),
+                                     len(tables[2]), len(tables[4])))
+            for table in tables:
+                data = to_little_endian(table)
+                f.write(data)
+                f.write(bytes(-len(data) % 8))
+    
+    @classmethod
+    def load(cls, path):
+        """Map a model file written by save() into a new MarkovData
+        
+        The tables are read-only views of the mapped file, so nothing is
+        parsed or copied and loading takes the same time for any model size.
+        
+        :param path: The file to read
+        :return: The loaded MarkovData
+        :raises ValueError: If the file is not a model file this version of
+        MarkovData can read
+        """
+        
+        with open(path, 'rb') as f:
+            # Too short for a header, or empty, which can't be mapped
+            if len(f.read(FILE_HEADER.size)) < FILE_HEADER.size:
+                raise ValueError('"%s" is not a markov data file' % path)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        view = memoryview(mapped)
+        (magic, version, wide, num_pairs, num_colors, num_transitions,
+         num_random) = FILE_HEADER.unpack_from(view)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError('"%s" is not a version %d markov data file'
+                             % (path, FILE_VERSION))
+        
+        lengths = [num_colors, num_colors + 1, num_transitions,
+                   num_transitions, num_random, num_random]
+        tables = []
+        pos = FILE_HEADER.size
+        types = WIDE_TABLE_TYPES if wide else TABLE_TYPES
+        for typecode, length in zip(types, lengths):
+            size = length * array(typecode).itemsize
+            if pos + size > len(view):
+                # Truncated file
+                raise ValueError('"%s" is not a version %d markov data file'
+                                 % (path, FILE_VERSION))
+            tables.append(from_little_endian(view[pos:pos + size], typecode))
+            pos += size + -size % 8
+        
+        markov = cls()
+        markov.num_pairs = num_pairs
+        markov.first_color_count = None
+        markov.data = None
+        markov.tables = tuple(tables)
+        markov.mapped = mapped
+        return markov
     
     def __contains__(self, color):
-        return color in self.data
+        if self.data is not None:
+            return color in self.data
+        
+        # Loaded models look the color up in the sorted first colors
+        return self.contains_int(get_color_int(color))
+    
+    def __getstate__(self):
+        # Leave the sampling tables out of pickles, they are rebuilt on demand
+        self.unpack()
+        state = dict(self.__dict__)
+        state['tables'] = None
+        state['mapped'] = None
+        return state
+    
+    def __setstate__(self, state):
+        # Pickles from before the sampling tables existed don't have them
+        self.tables = None
+        self.mapped = None
+        self.__dict__.update(state)
+
+
+def read_pickle(path):
+    """Read a MarkovData pickled by older versions of markov_images
+    
+    :param path: The pickle file to read
+    :return: The MarkovData
+    """
+    
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def convert_pickle(in_path, out_path):
+    """Convert a pickled MarkovData into a binary model file
+    
+    :param in_path: The pickle file to read
+    :param out_path: The model file to write
+    """
+    
+    read_pickle(in_path).save(out_path)
 
 
 def getRGBA(color):
@@ -78,20 +421,110 @@ def getRGBA(color):
 
 
 def get_color_int(rgba):
-    num = 0
-    for channel in rgba:
-        # Add channel value to appropriate bits
-        num <<= 8
-        num += channel
-    
-    return num
+    # Each channel is one byte, first channel in the highest bits
+    return int.from_bytes(bytes(rgba), 'big')
 
 
 def get_color_tuple(num):
-    rgba = [0 for i in range(4)]
-    for i in range(3, -1, -1):
-        # Add channel value to appropriate bits
-        rgba[i] = num % 256
-        num >>= 8
+    # Four channels from the highest byte to the lowest
+    return tuple(num.to_bytes(4, 'big'))
+
+
+def sum_sorted_counts(keys, counts):
+    """Sum the counts of repeated keys
+    
+    :param keys: A NumPy array of keys, possibly repeated
+    :param counts: A NumPy array of the count of each key
+    :return: The sorted distinct keys and their total counts
+    """
+    
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    counts = counts[order]
+    
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def tables_from_pair_counts(keys, counts, num_pairs):
+    """Build the sampling tables that finalize() would from arrays of pairs
+    
+    :param keys: A sorted NumPy array of distinct pairs, packed like
+    record_pair_counts takes
+    :param counts: A NumPy array of each pair's count
+    :param num_pairs: The total count, which decides the table types
+    :return: The tables, as arrays
+    """
+    
+    types = TABLE_TYPES if num_pairs < 2 ** 32 else WIDE_TABLE_TYPES
+    firsts = keys >> np.uint64(32)
+    seconds = keys & np.uint64(0xFFFFFFFF)
+    
+    # Sorted keys are grouped by first color, one row per first color
+    colors = np.unique(firsts)
+    offsets = np.append(np.searchsorted(firsts, colors), len(keys))
+    
+    # Running totals of each row, from running totals of the whole array
+    totals = np.cumsum(counts)
+    row_bases = totals[offsets[:-1]] - counts[offsets[:-1]]
+    cumulative = totals - np.repeat(row_bases, np.diff(offsets))
+    
+    # How often each color was second, for random colors
+    random_colors, random_counts = sum_sorted_counts(seconds, counts)
+    random_cumulative = np.cumsum(random_counts)
+    
+    tables = []
+    for typecode, values in zip(types, [colors, offsets, seconds, cumulative,
+                                        random_colors, random_cumulative]):
+        table = array(typecode)
+        table.frombytes(values.astype(np.dtype(typecode)).tobytes())
+        tables.append(table)
+    return tuple(tables)
+
+
+def to_little_endian(values):
+    """Get the bytes of an array, bytearray or memoryview in little-endian
+    order
+    
+    This and from_little_endian are kept the same as the copies in
+    LanguageGeneration/word_data.py, since the two folders are run as separate
+    scripts and share no modules.
+    """
+    
+    view = memoryview(values)
+    if sys.byteorder == 'little' or view.itemsize == 1:
+        return view.cast('B')
+    
+    # Memoryviews of arrays and casts of them have the typecode as format
+    swapped = array(view.format, view.tobytes())
+    swapped.byteswap()
+    return memoryview(swapped).cast('B')
+
+
+def from_little_endian(data, typecode):
+    """View little-endian bytes as an array of typecode, copying only if the
+    machine is big-endian
+    
+    :param data: A memoryview of the bytes
+    :param typecode: The array typecode of the values
+    :return: A read-only memoryview, or an array on big-endian machines
+    """
+    
+    if sys.byteorder == 'little':
+        return data.cast(typecode)
+    
+    values = array(typecode, data.tobytes())
+    values.byteswap()
+    return values
+
+
+if __name__ == '__main__':
+    # Convert an old pickled model: markov_data.py PICKLE_FILE OUT_FILE
+    if len(sys.argv) != 3:
+        print('\nUsage:  markov_data.py PICKLE_FILE OUT_FILE\n')
+        exit(1)
     
-    return tuple(rgba)
+    convert_pickle(sys.argv[1], sys.argv[2])
+    print('Converted "' + sys.argv[1] + '" to "' + sys.argv[2] + '".')
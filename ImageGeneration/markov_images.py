@@ -1,20 +1,37 @@
 # Author
 # William Lucca
 
+import os
 import sys
-import random
+import time
+import zlib
+import heapq
 import queue
-import pickle
-from markov_data import MarkovData
+import random
+import struct
+import threading
+import multiprocessing
+import numpy as np
+import quantize
+from markov_data import MarkovData, read_pickle
+from neighborhood_data import NeighborhoodData
 from PIL import Image
 
 # Command line options
-OPTIONS = ['-h', '-W', '-H', '-o', '-s', '-wm', '-rm']
+OPTIONS = ['-h', '-W', '-H', '-o', '-s', '-wm', '-rm', '-e', '-p', '-t',
+           '-q', '-n', '--profile', '-f']
 
 # Default settings
 DEFAULT_WIDTH = 300
 DEFAULT_HEIGHT = 300
 DEFAULT_OUT_PATH = 'output_image.png'
+DEFAULT_TILE_SIZE = 256
+
+# Most snapshots waiting to be written before new ones are skipped
+MAX_PENDING_SNAPSHOTS = 8
+
+# PNG file signature
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
 # Offsets for iterating over neighbors
 DX = [0, 1, 0, -1]
@@ -22,78 +39,723 @@ DY = [-1, 0, 1, 0]
 
 # Globals
 markov_data = MarkovData()
-colored = set()
 
+# Model generate_tile uses in worker processes (see set_tile_markov)
+tile_markov = None
 
-def color_pixel_from_neighbors(xy0, image):
-    # Iterate over neighbors and consider colors that exist in markov data
-    neighbor_colors = []
-    for i in range(len(DX)):
-        xy = (xy0[0] + DX[i], xy0[1] + DY[i])
+
+class ImageGenerator:
+    """Generates images from one model with its own random number generator
+    
+    The canvas buffers are allocated once and reused by every image of the
+    same size, so a long-lived generator can make any number of images
+    without reallocating. Generators share nothing with each other or with
+    the module's random state, so the same seed always gives the same images.
+    """
+    
+    def __init__(self, markov, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT,
+                 seed=None):
+        """Creates an ImageGenerator
+        
+        :param markov: The trained (or loaded) model to pick colors from
+        :param width: The width of the images to generate
+        :param height: The height of the images to generate
+        :param seed: Seed for the generator's random number generator
+        (random by default)
+        """
+        
+        self.markov = markov
+        self.rng = random.Random(seed)
+        self.width = 0
+        self.height = 0
+        self.canvas = None
+        self.painted = None
+        self.queued = None
+        self.resize(width, height)
+    
+    def resize(self, width, height):
+        """Change the size of the images to generate
+        
+        The buffers are only reallocated if the size actually changes.
+        
+        :param width: The new width
+        :param height: The new height
+        """
+        
+        if (width, height) == (self.width, self.height):
+            return
+        
+        self.width = width
+        self.height = height
+        self.canvas = np.zeros((height, width), dtype=np.uint32)
+        self.painted = np.zeros((height, width), dtype=bool)
+        self.queued = bytearray(width * height)
+    
+    def generate(self, seeds=None):
+        """Generate a canvas of packed colors
+        
+        :param seeds: The (x, y) pixels to start growing from (the center by
+        default)
+        :return: The generator's canvas, a (height, width) uint32 array that
+        the next call overwrites
+        """
+        
+        if seeds is None:
+            seeds = [(self.width // 2, self.height // 2)]
+        
+        self.canvas.fill(0)
+        self.painted.fill(False)
+        return generate_canvas(self.markov, self.width, self.height, seeds,
+                               self.rng, self.canvas, self.painted,
+                               self.queued)
+    
+    def generate_progressive(self, every, seeds=None):
+        """Generate a canvas of packed colors, pausing to show progress
+        
+        Generation only continues when the next canvas is asked for, and the
+        canvas yielded is the live one, so copy it to keep it.
+        
+        :param every: How many pixels to color between canvases
+        :param seeds: The (x, y) pixels to start growing from (the center by
+        default)
+        :return: A generator of the generator's canvas, every few pixels and
+        once more when finished
+        """
+        
+        if seeds is None:
+            seeds = [(self.width // 2, self.height // 2)]
+        
+        self.canvas.fill(0)
+        self.painted.fill(False)
+        count = 0
+        for count in grow_canvas(self.markov, self.width, self.height, seeds,
+                                 self.rng, self.canvas, self.painted,
+                                 self.queued, every):
+            yield self.canvas
         
-        # Add neighbor if in bounds of image
-        if in_bounds(xy, image):
-            color = image.getpixel(xy)
-            if color in markov_data and xy in colored:
-                neighbor_colors.append(color)
+        # Finish with the whole canvas, unless that was the last pause
+        if count < np.count_nonzero(self.painted):
+            yield self.canvas
     
-    # No markov neighbors returns random color
-    if len(neighbor_colors) == 0:
-        return markov_data.random_color()
+    def create_image(self, seeds=None):
+        """Generate an RGBA PIL image
+        
+        :param seeds: The (x, y) pixels to start growing from (the center by
+        default)
+        :return: The image
+        """
+        
+        return canvas_to_image(self.generate(seeds))
     
-    # Pick random neighbor color to use data from
-    return markov_data.next_color(random.choice(neighbor_colors))
+    def create_tiled_image(self, out_path, tile_size=DEFAULT_TILE_SIZE,
+                           processes=1):
+        """Generate an image tile by tile straight to a PNG file (see
+        create_tiled_image)
+        
+        :param out_path: The PNG file to write
+        :param tile_size: The width and height of each tile
+        :param processes: How many worker processes to generate tiles in, or
+        None for one per CPU
+        """
+        
+        create_tiled_image(self.width, self.height, out_path, tile_size,
+                           processes, self.markov, self.rng.getrandbits(64))
+
+
+def color_pixel_from_neighbors(markov, x, y, colors, painted, width, height,
+                               rng=random):
+    """Pick the color of a pixel from the colors of its painted neighbors
+    
+    :param markov: The model to pick colors from
+    :param x: The x coordinate of the pixel
+    :param y: The y coordinate of the pixel
+    :param colors: The canvas of packed colors, flattened row by row
+    :param painted: Whether each pixel of the canvas has been painted yet,
+    flattened the same way
+    :param width: The width of the canvas
+    :param height: The height of the canvas
+    :param rng: The random number generator to draw from
+    :return: The packed color for the pixel
+    """
+    
+    # Neighbor colors in DX/DY order, or -1 where there's nothing painted
+    neighbors = []
+    for i in range(len(DX)):
+        nx = x + DX[i]
+        ny = y + DY[i]
+        
+        if 0 <= nx < width and 0 <= ny < height and painted[ny * width + nx]:
+            neighbors.append(colors[ny * width + nx])
+        else:
+            neighbors.append(-1)
+    
+    return markov.color_from_neighbors(neighbors, rng)
 
 
 def create_image_from_point(x0, y0, width, height):
-    # Create image file
-    out_image = Image.new('RGBA', (width, height))
+    # Grow the image out from one point with markov_data
+    generator = ImageGenerator(markov_data, width, height,
+                               random.getrandbits(64))
+    return generator.create_image([(x0, y0)])
+
+
+def generate_canvas(markov, width, height, seeds, rng=random, canvas=None,
+                    painted=None, queued=None, callback=None, every=0):
+    """Color a canvas by growing out from seed pixels in a random order
+    
+    Each pixel waiting to be colored gets a random priority when it is first
+    reached, and the lowest priority pixel is colored next from its painted
+    neighbors.
+    
+    :param markov: The model to pick colors from
+    :param width: The width of the canvas
+    :param height: The height of the canvas
+    :param seeds: The (x, y) pixels to start growing from
+    :param rng: The random number generator to draw from
+    :param canvas: A (height, width) uint32 array of packed colors to paint
+    on, which may already have some pixels painted (a new one by default)
+    :param painted: A (height, width) bool array of which canvas pixels are
+    already painted; these are used as neighbors but never repainted
+    :param queued: A bytearray of width * height to keep track of which
+    pixels have been reached in (a new one by default)
+    :param callback: Function called with the canvas and the number of
+    pixels colored so far every few pixels, if given
+    :param every: How many pixels to color between calls of callback
+    :return: The canvas
+    """
+    
+    if canvas is None:
+        canvas = np.zeros((height, width), dtype=np.uint32)
+    if painted is None:
+        painted = np.zeros((height, width), dtype=bool)
+    if callback is None:
+        every = 0
+    
+    for count in grow_canvas(markov, width, height, seeds, rng, canvas,
+                             painted, queued, every):
+        callback(canvas, count)
+    
+    return canvas
+
+
+def grow_canvas(markov, width, height, seeds, rng, canvas, painted,
+                queued=None, every=0):
+    """Color a canvas like generate_canvas, pausing every few pixels
+    
+    :param markov: The model to pick colors from
+    :param width: The width of the canvas
+    :param height: The height of the canvas
+    :param seeds: The (x, y) pixels to start growing from
+    :param rng: The random number generator to draw from
+    :param canvas: A (height, width) uint32 array of packed colors to paint
+    :param painted: A (height, width) bool array of which canvas pixels are
+    already painted
+    :param queued: A bytearray of width * height to keep track of which
+    pixels have been reached in (a new one by default)
+    :param every: How many pixels to color between pauses, or 0 to never
+    pause
+    :return: A generator of the number of pixels colored so far, at each
+    pause
+    """
+    
     num_pixels = width * height
+    count = 0
     
-    # Iterate over all pixels
-    to_color = queue.PriorityQueue()
-    to_color.put((0, (x0, y0)))
-    while not to_color.empty():
+    # Flat views of the arrays, which are much faster to index one at a time
+    colors = memoryview(canvas).cast('B').cast('I')
+    done = memoryview(painted).cast('B')
+    if queued is None:
+        queued = bytearray(done)
+    else:
+        queued[:] = done
+    
+    # Frontier heap of priority * num_pixels + pixel index
+    frontier = []
+    for x, y in seeds:
+        i = y * width + x
+        if not queued[i]:
+            queued[i] = 1
+            frontier.append(rng.randrange(num_pixels) * num_pixels + i)
+    heapq.heapify(frontier)
+    
+    while len(frontier) > 0:
         # Color next pixel
-        xy = to_color.get()[1]
-        color = color_pixel_from_neighbors(xy, out_image)
-        out_image.putpixel(xy, color)
+        i = heapq.heappop(frontier) % num_pixels
+        x = i % width
+        y = i // width
+        colors[i] = color_pixel_from_neighbors(markov, x, y, colors, done,
+                                               width, height, rng)
+        done[i] = 1
+        
+        # Pause to show progress
+        if every > 0:
+            count += 1
+            if count % every == 0:
+                yield count
+        
+        # Add adjacent pixels to the frontier
+        for k in range(len(DX)):
+            ax = x + DX[k]
+            ay = y + DY[k]
+            if 0 <= ax < width and 0 <= ay < height:
+                j = ay * width + ax
+                if not queued[j]:
+                    queued[j] = 1
+                    heapq.heappush(frontier,
+                                   rng.randrange(num_pixels) * num_pixels + j)
+
+
+class SnapshotWriter:
+    """Writes snapshots of a canvas to numbered image files on a background
+    thread
+    
+    Snapshots are copied when submitted and converted and saved by the
+    thread, so generation only pauses for the copy. If the writer falls more
+    than MAX_PENDING_SNAPSHOTS behind, new snapshots are skipped rather than
+    holding generation up. If a snapshot can't be written, the rest are
+    skipped and the error is raised again by close().
+    """
+    
+    def __init__(self, path_pattern, max_pending=MAX_PENDING_SNAPSHOTS):
+        """Creates a SnapshotWriter and starts its thread
+        
+        :param path_pattern: The file path for the snapshots, with a %d
+        format for the snapshot number
+        :param max_pending: Most snapshots to hold waiting to be written
+        """
         
-        # Add adjacent pixels to queue/colored set
-        for i in range(len(DX)):
-            adj_xy = (xy[0] + DX[i], xy[1] + DY[i])
-            if in_bounds(adj_xy, out_image) and adj_xy not in colored:
-                colored.add(adj_xy)
-                to_color.put((random.randrange(0, num_pixels), adj_xy))
+        self.path_pattern = path_pattern
+        self.pending = queue.Queue(max_pending)
+        self.num_submitted = 0
+        self.num_written = 0
+        self.num_skipped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
     
-    return out_image
+    def submit(self, canvas):
+        """Queue a copy of a canvas to be written
+        
+        :param canvas: The canvas of packed colors
+        """
+        
+        if self.error is not None or self.pending.full():
+            self.num_skipped += 1
+            return
+        
+        self.pending.put((self.num_submitted, canvas.copy()))
+        self.num_submitted += 1
+    
+    def run(self):
+        # Write snapshots until the None that close() sends, keeping the
+        # queue drained after an error so submit() and close() never block
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                break
+            if self.error is not None:
+                self.num_skipped += 1
+                continue
+            
+            number, canvas = snapshot
+            try:
+                canvas_to_image(canvas).save(self.path_pattern % number,
+                                             compress_level=1)
+                self.num_written += 1
+            except Exception as e:
+                self.error = e
+                self.num_skipped += 1
+    
+    def close(self):
+        """Wait for the pending snapshots to be written and stop the thread
+        
+        Raises the first error from writing a snapshot, if there was one.
+        """
+        
+        # Only wait for room in the queue while the thread can make some
+        while self.thread.is_alive():
+            try:
+                self.pending.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.thread.join()
+        
+        if self.error is not None:
+            raise self.error
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
-def analyze_image(path):
-    image = Image.open(path)
-    for x in range(1, image.width):
-        for y in range(1, image.height):
-            # Add color pair from left to right
-            markov_data.record_pair(image.getpixel((x, y)),
-                                    image.getpixel((x - 1, y)))
-            # Add color pair from top to bottom
-            markov_data.record_pair(image.getpixel((x, y)),
-                                    image.getpixel((x, y - 1)))
-    image.close()
+def snapshot_pattern(path):
+    """Get the numbered file path pattern for snapshots of an output image
+    
+    :param path: The output image path, like "out.png"
+    :return: The snapshot path pattern, like "out_%04d.png"
+    """
+    
+    root, ext = os.path.splitext(path)
+    return root + '_%04d' + ext
 
 
-def in_bounds(xy, image):
-    x, y = xy[0], xy[1]
-    if 0 <= x < image.width and 0 <= y < image.height:
-        return True
-    return False
+def canvas_to_image(canvas):
+    """Convert a canvas of packed colors into an RGBA PIL image"""
+    
+    # Packed colors have the first channel in the highest byte
+    rgba = canvas.astype('>u4').view(np.uint8)
+    return Image.fromarray(rgba.reshape(canvas.shape + (4,)))
+
+
+def create_tiled_image(width, height, out_path, tile_size=DEFAULT_TILE_SIZE,
+                       processes=1, markov=None, seed=None):
+    """Generate an image tile by tile and stream it straight to a PNG file
+    
+    The image is made one band of tiles at a time. Within a band, every
+    other tile is generated first, knowing only the bottom row of the band
+    above, and then the tiles between them are generated knowing the edges
+    of the tiles on either side as well. Each tile grows from its center and
+    colors its edge pixels from their painted neighbors like any other pixel,
+    so tiles join up by the same markov rule as the rest of the image.
+    
+    Only one band is held in memory, so the image can be far bigger than
+    would fit in memory as a whole.
+    
+    :param width: The width of the image
+    :param height: The height of the image
+    :param out_path: The PNG file to write
+    :param tile_size: The width and height of each tile
+    :param processes: How many worker processes to generate tiles in, or
+    None for one per CPU
+    :param markov: The model to pick colors from (markov_data by default)
+    :param seed: The image seed (random by default). Every tile gets its own
+    generator seeded from it, so the image is the same however many
+    processes make it
+    """
+    
+    if markov is None:
+        markov = markov_data
+    if seed is None:
+        seed = random.getrandbits(64)
+    
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes, set_tile_markov, (markov,))
+        generate = pool.map
+    else:
+        set_tile_markov(markov)
+        generate = map
+    
+    try:
+        with open(out_path, 'wb') as fp:
+            compressor = zlib.compressobj()
+            fp.write(PNG_SIGNATURE)
+            write_png_chunk(fp, b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                                     8, 6, 0, 0, 0))
+            
+            above = None
+            for y0 in range(0, height, tile_size):
+                band_height = min(tile_size, height - y0)
+                band = np.zeros((band_height, width), dtype=np.uint32)
+                
+                # Tiles starting on even then odd multiples of the tile size
+                for phase in range(2):
+                    tasks = []
+                    for x0 in range(phase * tile_size, width, 2 * tile_size):
+                        x1 = min(x0 + tile_size, width)
+                        left = None
+                        right = None
+                        if phase == 1:
+                            left = band[:, x0 - 1]
+                            if x1 < width:
+                                right = band[:, x1]
+                        tasks.append((seed, x0, y0, x1 - x0, band_height,
+                                      above, left, right))
+                    
+                    for x0, tile in zip([task[1] for task in tasks],
+                                        generate(generate_tile, tasks)):
+                        band[:, x0:x0 + tile.shape[1]] = tile
+                
+                write_png_chunk(fp, b'IDAT', compressor.compress(
+                    png_rows(band)))
+                above = band[-1].copy()
+            
+            write_png_chunk(fp, b'IDAT', compressor.flush())
+            write_png_chunk(fp, b'IEND', b'')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def set_tile_markov(markov):
+    """Set the model generate_tile uses (once per worker process)"""
+    
+    global tile_markov
+    
+    tile_markov = markov
+
+
+def generate_tile(task):
+    """Generate one tile of a tiled image (in a worker process)
+    
+    :param task: The image seed, the tile's x and y position, width and
+    height, and the already painted pixels touching it: the row above the
+    tile and the columns to its left and right, each None if not there. The
+    row above covers the whole image width
+    :return: The tile as a (height, width) uint32 array of packed colors
+    """
+    
+    seed, x0, y0, width, height, above, left, right = task
+    rng = random.Random('%d:%d:%d' % (seed, x0, y0))
+    
+    # Put the tile in a canvas with a border of its painted neighbors
+    top = 0 if above is None else 1
+    first = 0 if left is None else 1
+    last = 0 if right is None else 1
+    canvas_height = height + top
+    canvas_width = width + first + last
+    canvas = np.zeros((canvas_height, canvas_width), dtype=np.uint32)
+    painted = np.zeros((canvas_height, canvas_width), dtype=bool)
+    if above is not None:
+        canvas[0] = above[x0 - first:x0 + width + last]
+        painted[0] = True
+    if left is not None:
+        canvas[top:, 0] = left
+        painted[top:, 0] = True
+    if right is not None:
+        canvas[top:, -1] = right
+        painted[top:, -1] = True
+    
+    seeds = [(first + width // 2, top + height // 2)]
+    generate_canvas(tile_markov, canvas_width, canvas_height, seeds, rng,
+                    canvas, painted)
+    return canvas[top:, first:first + width]
+
+
+def png_rows(canvas):
+    """Get the PNG scanlines of a canvas of packed colors, unfiltered"""
+    
+    height, width = canvas.shape
+    rows = np.zeros((height, 4 * width + 1), dtype=np.uint8)
+    rows[:, 1:] = canvas.astype('>u4').view(np.uint8)
+    return rows.tobytes()
+
+
+def write_png_chunk(fp, tag, data):
+    """Write one chunk of a PNG file
+    
+    :param fp: The file to write to
+    :param tag: The four byte chunk type
+    :param data: The chunk contents
+    """
+    
+    fp.write(struct.pack('>I', len(data)))
+    fp.write(tag)
+    fp.write(data)
+    fp.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+
+def analyze_image(path, include_edges=False, palette=None):
+    """Record the neighboring color pairs of an image in markov_data
+    
+    Each pixel is paired with its left neighbor and then its up neighbor,
+    column by column, exactly as record_pair would be called pixel by pixel.
+    
+    :param path: The image file to analyze
+    :param include_edges: Also record pairs from the first row and column.
+    By default they are skipped, as they always have been
+    :param palette: Snap every color to the nearest color of this palette
+    (see build_palette) before counting, if given
+    """
+    
+    keys, counts = count_image_pairs(path, include_edges, palette)
+    markov_data.record_pair_counts(keys.tolist(), counts.tolist())
+
+
+def analyze_images(paths, include_edges=False, processes=1, palette=None):
+    """Record the neighboring color pairs of many images in markov_data
+    
+    The pairs of each image are counted with NumPy, by a worker process each
+    with more than one process, which sends back just the arrays of distinct
+    pairs and counts. The arrays of every image are then summed and turned
+    into the sampling tables with NumPy too (see
+    MarkovData.record_pair_arrays), so no work per pair is left in Python.
+    The tables, and so the saved model file, are byte for byte the same as
+    analyzing the images one after another with analyze_image, for any
+    number of processes (see benchmark_images.check_analysis).
+    
+    :param paths: The image files to analyze
+    :param include_edges: Also record pairs from the first row and column
+    :param processes: How many worker processes to use, or None for one per
+    CPU
+    :param palette: Snap every color to the nearest color of this palette
+    before counting, if given
+    """
+    
+    tasks = [(path, include_edges, palette) for path in paths]
+    if len(tasks) == 0:
+        return
+    if processes == 1:
+        tables = [count_image_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            tables = pool.map(count_image_task, tasks)
+    
+    markov_data.record_pair_arrays(
+        np.concatenate([keys for keys, counts in tables]),
+        np.concatenate([counts for keys, counts in tables]))
+
+
+def analyze_neighborhoods(paths, processes=1, palette=None):
+    """Record the neighborhoods of every pixel of many images in markov_data
+    
+    markov_data must be a NeighborhoodData. With more than one process, each
+    worker records one image at a time into its own NeighborhoodData, and
+    they are merged in image order.
+    
+    :param paths: The image files to analyze
+    :param processes: How many worker processes to use, or None for one per
+    CPU
+    :param palette: Snap every color to the nearest color of this palette
+    before counting, if given
+    """
+    
+    tasks = [(path, palette, markov_data.joint) for path in paths]
+    if processes == 1:
+        for task in tasks:
+            markov_data.merge(neighborhood_task(task))
+        return
+    
+    with multiprocessing.Pool(processes) as pool:
+        for image_data in pool.imap(neighborhood_task, tasks):
+            markov_data.merge(image_data)
+
+
+def neighborhood_task(task):
+    """Record the neighborhoods of one image (in a worker process)
+    
+    :param task: The image path, the palette and whether to model pairs of
+    neighbors
+    :return: The NeighborhoodData of the image
+    """
+    
+    path, palette, joint = task
+    with Image.open(path) as image:
+        colors = image_colors(image)
+    if palette is not None:
+        colors = quantize.quantize_colors(colors, palette)
+    
+    image_data = NeighborhoodData(joint)
+    image_data.record_image(colors)
+    return image_data
+
+
+def count_image_task(task):
+    """Count the pairs of one image (in a worker process)
+    
+    :param task: The image path, whether to include edges and the palette
+    :return: The arrays of distinct pairs and their counts
+    """
+    
+    return count_image_pairs(*task)
+
+
+def count_image_pairs(path, include_edges=False, palette=None):
+    """Count the neighboring color pairs of an image with NumPy
+    
+    :param path: The image file to analyze
+    :param include_edges: Also count pairs from the first row and column
+    :param palette: Snap every color to the nearest color of this palette
+    before counting, if given
+    :return: Arrays of the distinct pairs, packed as
+    (get_color_int(color1) << 32) | get_color_int(color2), and of their
+    counts, in the order each pair first appears
+    """
+    
+    with Image.open(path) as image:
+        colors = image_colors(image)
+    if palette is not None:
+        colors = quantize.quantize_colors(colors, palette)
+    colors = colors.astype(np.uint64)
+    width, height = colors.shape
+    
+    # Pairs of each pixel with its left and up neighbors, for every pixel
+    pairs = np.zeros((width, height, 2), dtype=np.uint64)
+    pairs[1:, :, 0] = (colors[1:, :] << np.uint64(32)) | colors[:-1, :]
+    pairs[:, 1:, 1] = (colors[:, 1:] << np.uint64(32)) | colors[:, :-1]
+    
+    # Keep the pixels that have the neighbors being recorded
+    valid = np.zeros((width, height, 2), dtype=bool)
+    if include_edges:
+        valid[1:, :, 0] = True
+        valid[:, 1:, 1] = True
+    else:
+        valid[1:, 1:, :] = True
+    pairs = pairs[valid]
+    
+    # Count each distinct pair and put them in order of first appearance
+    keys, first_index, counts = np.unique(pairs, return_index=True,
+                                          return_counts=True)
+    order = np.argsort(first_index)
+    return keys[order], counts[order]
+
+
+def build_palette(paths, palette_size):
+    """Build one palette for a set of images by median cut
+    
+    Sharing the palette keeps colors from different images the same, so
+    their pairs still add up in the markov data.
+    
+    :param paths: The image files to build the palette from
+    :param palette_size: The most colors to put in the palette
+    :return: A sorted uint32 array of packed palette colors
+    """
+    
+    samples = []
+    for path in paths:
+        with Image.open(path) as image:
+            samples.append(quantize.sample_colors(image_colors(image)))
+    
+    return quantize.median_cut(np.concatenate(samples), palette_size)
+
+
+def image_colors(image):
+    """Get an image's pixel colors as a (width, height) array of packed ints
+    
+    Colors are packed like get_color_int, with missing channels filled in
+    with 255 like getRGBA.
+    
+    :param image: The PIL image
+    :return: A uint32 array indexed by [x, y]
+    """
+    
+    # Palette images hold indices, not colors
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    
+    pixels = np.asarray(image, dtype=np.uint8)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    
+    rgba = np.full(pixels.shape[:2] + (4,), 255, dtype=np.uint8)
+    num_channels = min(pixels.shape[2], 4)
+    rgba[:, :, :num_channels] = pixels[:, :, :num_channels]
+    
+    # Pack channels big-endian, so the first channel is in the highest bits
+    packed = rgba.view('>u4')[:, :, 0].astype(np.uint32)
+    return packed.T
 
 
 def printhelp():
     # Print basic usage
     print('\nUsage:  markov_images.py',
           '[-h] [-W WIDTH] [-H HEIGHT] [-o PATH] [-s SEED] '
-          '[-wm FILE] [-rm FILE] input_images ...\n')
+          '[-wm FILE] [-rm FILE] [-e] [-p NUM] [-t SIZE] [-q COLORS] [-n] '
+          '[--profile] [-f NUM] input_images ...\n')
     
     # Print description of each option
     print('[' + OPTIONS[0] + ']\t\tDisplay this help message')
@@ -107,6 +769,20 @@ def printhelp():
                              '(uses random seed by default)')
     print('[' + OPTIONS[5] + ' FILE]\tWrite the markov data to a given file')
     print('[' + OPTIONS[6] + ' FILE]\tRead the markov data from a given file')
+    print('[' + OPTIONS[7] + ']\t\tAlso analyze the first row and column of '
+                             'each image')
+    print('[' + OPTIONS[8] + ' NUM]\tAnalyze images and generate tiles in NUM '
+                             'worker processes (default 1)')
+    print('[' + OPTIONS[9] + ' SIZE]\tGenerate the image in SIZE x SIZE '
+                             'tiles, writing it as it goes')
+    print('[' + OPTIONS[10] + ' COLORS]\tReduce the images to a shared '
+                              'palette of COLORS colors before analyzing')
+    print('[' + OPTIONS[11] + ']\t\tModel each neighbor direction separately '
+                              'and pairs of neighbors together')
+    print('[' + OPTIONS[12] + ']\tPrint the time, peak memory and slowest '
+                              'functions of each stage')
+    print('[' + OPTIONS[13] + ' NUM]\tAlso write a numbered snapshot every '
+                              'NUM pixels (not with -t)')
 
 
 def main():
@@ -125,6 +801,14 @@ def main():
     
     # Images to analyze
     to_analyze = []
+    include_edges = False
+    processes = 1
+    tile_size = 0
+    seed = None
+    palette_size = 0
+    neighborhoods = False
+    profiler = None
+    snapshot_every = 0
     
     # Iterate over command line arguments
     argv = ''
@@ -137,11 +821,21 @@ def main():
             # Display usage information
             printhelp()
             exit(0)
+        elif argv == '-e':
+            # Analyze the first row and column too
+            include_edges = True
+        elif argv == '-n':
+            # Use the neighborhood model
+            neighborhoods = True
+        elif argv == '--profile':
+            # Measure each stage (only imported when asked for)
+            import benchmark_images
+            profiler = benchmark_images.StageProfiler()
         elif argv in OPTIONS:
             continue
         elif prev == '-s':
             # Set random seed
-            random.seed(argv)
+            seed = argv
         elif prev == '-W':
             # Set output image width
             width = int(argv)
@@ -151,6 +845,18 @@ def main():
         elif prev == '-o':
             # Set output image filepath
             out_img_path = argv
+        elif prev == '-p':
+            # Set the number of analysis processes
+            processes = int(argv)
+        elif prev == '-t':
+            # Set the tile size
+            tile_size = int(argv)
+        elif prev == '-f':
+            # Set the number of pixels between snapshots
+            snapshot_every = int(argv)
+        elif prev == '-q':
+            # Set the palette size
+            palette_size = int(argv)
         elif prev == '-wm':
             # Set the output markov data filepath
             should_write_markov = True
@@ -164,22 +870,68 @@ def main():
             to_analyze.append(argv)
     
     # Analyze images
-    if should_read_markov:
-        with open(in_markov_path, 'rb') as fp:
-            markov_data = pickle.load(fp)
+    if should_read_markov and neighborhoods:
+        markov_data = NeighborhoodData.load(in_markov_path)
+    elif should_read_markov:
+        try:
+            markov_data = MarkovData.load(in_markov_path)
+        except ValueError:
+            # Fall back on models pickled by older versions
+            print('Reading pickled markov data, convert it with '
+                  'markov_data.py to load it faster.')
+            markov_data = read_pickle(in_markov_path)
     else:
-        for image in to_analyze:
-            analyze_image(image)
+        palette = None
+        if palette_size > 0:
+            start = time.perf_counter()
+            palette = build_palette(to_analyze, palette_size)
+            print('Built a palette of %d colors in %.2fs.'
+                  % (len(palette), time.perf_counter() - start))
+        
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.start('analyze')
+        if neighborhoods:
+            markov_data = NeighborhoodData()
+            analyze_neighborhoods(to_analyze, processes, palette)
+            print('Analyzed images in %.2fs: %d neighborhood states.'
+                  % (time.perf_counter() - start, len(markov_data.counts)))
+        else:
+            analyze_images(to_analyze, include_edges, processes, palette)
+            tables = markov_data.get_tables()
+            print('Analyzed images in %.2fs: %d colors, %d distinct pairs.'
+                  % (time.perf_counter() - start, len(tables[0]),
+                     len(tables[2])))
+        if profiler is not None:
+            profiler.stop(benchmark_images.count_pixels(to_analyze))
     
     # Write markov data
     if should_write_markov:
-        with open(out_markov_path, 'wb') as fp:
-            pickle.dump(markov_data, fp)
+        markov_data.save(out_markov_path)
     
     # Create an image
-    out = create_image_from_point(width // 2, height // 2, width, height)
-    out.save(out_img_path)
+    generator = ImageGenerator(markov_data, width, height, seed)
+    if profiler is not None:
+        profiler.start('generate')
+    if tile_size > 0:
+        generator.create_tiled_image(out_img_path, tile_size, processes)
+    elif snapshot_every > 0:
+        with SnapshotWriter(snapshot_pattern(out_img_path)) as writer:
+            for canvas in generator.generate_progressive(snapshot_every):
+                writer.submit(canvas)
+        canvas_to_image(generator.canvas).save(out_img_path)
+        print('Wrote %d snapshots (%d skipped).'
+              % (writer.num_written, writer.num_skipped))
+    else:
+        generator.create_image().save(out_img_path)
+    if profiler is not None:
+        profiler.stop(width * height)
     print('Success! Image "' + out_img_path + '" has been generated.')
+    
+    if profiler is not None:
+        print()
+        benchmark_images.print_report(profiler.results,
+                                      benchmark_images.PROFILE_LIMIT)
     exit(0)
 
 
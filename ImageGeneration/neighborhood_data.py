@@ -0,0 +1,227 @@
+# Author
+# William Lucca
+
+import pickle
+import random
+from bisect import bisect_right
+
+import numpy as np
+
+# Offsets of the neighbors, in the same order as markov_images
+DX = [0, 1, 0, -1]
+DY = [-1, 0, 1, 0]
+
+# Pairs of neighbor directions modelled together
+JOINT_PAIRS = [(k1, k2) for k1 in range(len(DX))
+               for k2 in range(k1 + 1, len(DX))]
+
+
+class NeighborhoodData:
+    """Markov model of pixel colors given their neighbors' colors
+    
+    There is a separate table of which colors appear next to each color for
+    every neighbor direction, and a table for every pair of directions of
+    which colors appear between each pair of colors. A pixel is colored from
+    the joint tables of its painted neighbors when any of them has data,
+    backing off to the tables of single neighbors, and then to a random
+    color weighted by how common it is.
+    
+    Every state of every table is a key in one index dict, so finding the
+    row for a state is one lookup. Colors are packed like get_color_int.
+    """
+    
+    def __init__(self, joint=True):
+        """Creates an empty NeighborhoodData
+        
+        :param joint: Also model pairs of neighbors together
+        """
+        
+        self.joint = joint
+        
+        # Counts of colors in each state, keyed by table << 64 | state
+        self.counts = dict()
+        self.color_counts = dict()
+        
+        # Sampling rows built from the counts on demand, None when out of date
+        self.index = None
+        self.random_row = None
+    
+    def record_image(self, colors):
+        """Add every pixel of an image and its neighbors to the counts
+        
+        :param colors: A (width, height) array of packed colors, like
+        markov_images.image_colors gives
+        """
+        
+        self.index = None
+        colors = np.asarray(colors, dtype=np.uint32)
+        
+        # One neighbor per state
+        for k in range(len(DX)):
+            pixels, (neighbors,) = neighborhood_views(colors, [k])
+            keys = (neighbors.astype(np.uint64) << np.uint64(32)) | pixels
+            keys, counts = np.unique(keys, return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.add_count(k << 64 | key >> 32, key & 0xFFFFFFFF, count)
+        
+        # Two neighbors per state
+        if self.joint:
+            for i, pair in enumerate(JOINT_PAIRS):
+                pixels, (first, second) = neighborhood_views(colors, pair)
+                states = (first.astype(np.uint64) << np.uint64(32)) | second
+                rows, counts = np.unique(np.stack([states, pixels], axis=1),
+                                         axis=0, return_counts=True)
+                table = (len(DX) + i) << 64
+                for (state, color), count in zip(rows.tolist(),
+                                                 counts.tolist()):
+                    self.add_count(table | state, color, count)
+        
+        # Every color, for random colors
+        distinct, counts = np.unique(colors, return_counts=True)
+        for color, count in zip(distinct.tolist(), counts.tolist()):
+            self.color_counts[color] = self.color_counts.get(color, 0) + count
+    
+    def add_count(self, key, color, count):
+        """Add to the count of a color in one state of one table"""
+        
+        row = self.counts.get(key)
+        if row is None:
+            self.counts[key] = {color: count}
+        else:
+            row[color] = row.get(color, 0) + count
+    
+    def merge(self, other):
+        """Add all of another NeighborhoodData's counts into this one
+        
+        :param other: The NeighborhoodData to add
+        """
+        
+        for key, row in other.counts.items():
+            for color, count in row.items():
+                self.add_count(key, color, count)
+        for color, count in other.color_counts.items():
+            self.color_counts[color] = self.color_counts.get(color, 0) + count
+        self.index = None
+    
+    def finalize(self):
+        """Build the sampling rows from the counts
+        
+        Each row is a list of colors and a list of their running count
+        totals. Sampling calls this automatically when the counts have
+        changed since the rows were last built.
+        """
+        
+        self.index = {key: counts_row(row) for key, row in self.counts.items()}
+        self.random_row = counts_row(self.color_counts)
+    
+    def get_index(self):
+        """Get the sampling index, building it first if out of date"""
+        
+        if self.index is None:
+            self.finalize()
+        return self.index
+    
+    def color_from_neighbors(self, neighbors, rng=random):
+        """Pick a pixel color given the colors of its neighbors
+        
+        :param neighbors: The packed colors of the neighbors in DX/DY order,
+        -1 for any neighbor that isn't painted
+        :param rng: The random number generator to draw from
+        :return: The packed color
+        """
+        
+        index = self.get_index()
+        
+        # Rows of every pair of painted neighbors with data
+        rows = []
+        if self.joint:
+            for i, (k1, k2) in enumerate(JOINT_PAIRS):
+                first = neighbors[k1]
+                second = neighbors[k2]
+                if first >= 0 and second >= 0:
+                    row = index.get((len(DX) + i) << 64 | first << 32 | second)
+                    if row is not None:
+                        rows.append(row)
+        
+        # Back off to single painted neighbors
+        if len(rows) == 0:
+            for k, color in enumerate(neighbors):
+                if color >= 0:
+                    row = index.get(k << 64 | color)
+                    if row is not None:
+                        rows.append(row)
+        
+        # Back off to a random color
+        if len(rows) == 0:
+            row = self.random_row
+        else:
+            row = rng.choice(rows)
+        
+        colors, cumulative = row
+        return colors[bisect_right(cumulative, rng.random() * cumulative[-1])]
+    
+    def save(self, path):
+        """Write the counts to a file
+        
+        :param path: The file to write
+        """
+        
+        with open(path, 'wb') as fp:
+            pickle.dump(self, fp)
+    
+    @classmethod
+    def load(cls, path):
+        """Read a NeighborhoodData written by save()
+        
+        :param path: The file to read
+        :return: The loaded NeighborhoodData
+        """
+        
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+    
+    def __getstate__(self):
+        # Leave the sampling rows out of pickles, they are rebuilt on demand
+        state = dict(self.__dict__)
+        state['index'] = None
+        state['random_row'] = None
+        return state
+
+
+def counts_row(counts):
+    """Turn a dict of color counts into a sampling row
+    
+    :param counts: The count of each packed color
+    :return: The list of colors and the list of their running count totals
+    """
+    
+    colors = []
+    cumulative = []
+    total = 0
+    for color, count in counts.items():
+        total += count
+        colors.append(color)
+        cumulative.append(total)
+    return colors, cumulative
+
+
+def neighborhood_views(colors, directions):
+    """Get the pixels that have neighbors in some directions, and those
+    neighbors
+    
+    :param colors: A (width, height) array of packed colors
+    :param directions: The neighbor directions, as indices into DX and DY
+    :return: A flat array of the pixels, and a list of flat arrays of their
+    neighbors in each direction, in the same order
+    """
+    
+    width, height = colors.shape
+    x0 = max([0] + [-DX[k] for k in directions])
+    x1 = width - max([0] + [DX[k] for k in directions])
+    y0 = max([0] + [-DY[k] for k in directions])
+    y1 = height - max([0] + [DY[k] for k in directions])
+    
+    pixels = colors[x0:x1, y0:y1].ravel()
+    neighbors = [colors[x0 + DX[k]:x1 + DX[k], y0 + DY[k]:y1 + DY[k]].ravel()
+                 for k in directions]
+    return pixels, neighbors
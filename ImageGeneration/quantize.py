@@ -0,0 +1,111 @@
+# Author
+# William Lucca
+
+import numpy as np
+
+# Most pixels sampled from each image when building a palette
+SAMPLE_SIZE = 100000
+
+# Most pixel-by-palette distances computed at once when mapping colors
+CHUNK_SIZE = 1 << 20
+
+
+def median_cut(colors, palette_size):
+    """Build a palette from pixels by median cut
+    
+    Starting from one box holding every pixel, the box with the widest range
+    in any channel is split at the median of that channel until there are
+    palette_size boxes (or no box can be split). Each box's mean color goes
+    in the palette.
+    
+    :param colors: A uint32 array of packed colors
+    :param palette_size: The most colors to put in the palette
+    :return: A sorted uint32 array of the palette colors, packed like
+    get_color_int
+    """
+    
+    boxes = [unpack_colors(colors)]
+    ranges = [channel_ranges(boxes[0])]
+    while len(boxes) < palette_size:
+        # Find the box and channel with the widest range
+        widest = max(range(len(boxes)), key=lambda i: ranges[i].max())
+        if ranges[widest].max() == 0:
+            break
+        
+        # Split it in half along that channel
+        box = boxes.pop(widest)
+        channel = ranges.pop(widest).argmax()
+        order = np.argsort(box[:, channel], kind='stable')
+        half = len(box) // 2
+        for part in (box[order[:half]], box[order[half:]]):
+            boxes.append(part)
+            ranges.append(channel_ranges(part))
+    
+    palette = np.array([box.mean(axis=0) for box in boxes if len(box) > 0])
+    return np.unique(pack_colors(np.rint(palette).astype(np.uint8)))
+
+
+def channel_ranges(pixels):
+    """Get the range of each channel of an (n, 4) array of RGBA pixels"""
+    
+    if len(pixels) < 2:
+        return np.zeros(4, dtype=int)
+    return pixels.max(axis=0).astype(int) - pixels.min(axis=0)
+
+
+def sample_colors(colors, sample_size=SAMPLE_SIZE, rng=None):
+    """Pick a random sample of an image's colors for building a palette
+    
+    :param colors: A uint32 array of packed colors, of any shape
+    :param sample_size: The most colors to pick
+    :param rng: The NumPy generator to draw from (seeded with 0 by default,
+    so the same images always give the same palette)
+    :return: A flat uint32 array of the sampled colors
+    """
+    
+    if rng is None:
+        rng = np.random.default_rng(0)
+    
+    colors = colors.ravel()
+    if len(colors) > sample_size:
+        colors = rng.choice(colors, sample_size, replace=False)
+    return colors
+
+
+def quantize_colors(colors, palette):
+    """Replace every color with the nearest palette color
+    
+    Each distinct color is only looked up once, and the distances are
+    computed a chunk at a time so memory stays bounded.
+    
+    :param colors: A uint32 array of packed colors, of any shape
+    :param palette: A uint32 array of packed palette colors
+    :return: A uint32 array of packed palette colors, shaped like colors
+    """
+    
+    distinct, inverse = np.unique(colors, return_inverse=True)
+    pixels = unpack_colors(distinct).astype(np.float32)
+    targets = unpack_colors(palette).astype(np.float32)
+    target_norms = (targets * targets).sum(axis=1)
+    
+    nearest = np.empty(len(distinct), dtype=np.intp)
+    step = max(1, CHUNK_SIZE // len(palette))
+    for start in range(0, len(distinct), step):
+        # |pixel - target|^2 without the |pixel|^2 that every target shares
+        chunk = pixels[start:start + step]
+        distances = target_norms - 2 * (chunk @ targets.T)
+        nearest[start:start + step] = distances.argmin(axis=1)
+    
+    return palette[nearest][inverse].reshape(colors.shape)
+
+
+def pack_colors(pixels):
+    """Pack an (n, 4) uint8 array of RGBA pixels into a uint32 array"""
+    
+    return np.ascontiguousarray(pixels).view('>u4')[:, 0].astype(np.uint32)
+
+
+def unpack_colors(colors):
+    """Unpack a uint32 array of packed colors into (n, 4) uint8 RGBA"""
+    
+    return colors.astype('>u4').view(np.uint8).reshape(-1, 4)
@@ -1,120 +1,345 @@
 # Author
 # William Lucca
 
+import io
+import itertools
+import multiprocessing
+import os
 import random
+import sys
+from collections import deque
+
+import tokenizers
+from word_data import WordData
 
 FILES = [
     'star-wars-a-new-hope.txt'
 ]
+ENCODING = 'utf-8'
+
+# Command line options
+OPTIONS = ['-h', '-wm', '-rm']
+
+# Approximate number of bytes of text per parallel training task
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Most chunks being trained at once per worker process
+TRAINING_WINDOW = 2
+
+# Number of previous words that make up a state in the chain
+ORDER = 1
 
 # Markov chain data
-starting_words = []
-word_dicts = {}
+word_data = WordData(ORDER)
+
+# Function splitting a line of text into tokens (see tokenizers.py)
+TOKENIZER = tokenizers.regex_tokens
 
 # Other rules
 TERMINAL_PUNCTUATION = ['.', '?', '!', '.\"']
+CLOSING_PUNCTUATION = ['"', "'", ')', ']', '}']
+MAX_WORDS = 100
 
 
 def add_pair_to_dict(first, second):
     """Mark word pair in the dictionary as an existing/more common relationship
     
-    :param first: The preceding word, as it appears in the training data
+    :param first: The preceding words (up to ORDER of them, oldest first) as
+    a tuple, as they appear in the training data
     :param second: The following word, as it appears in the training data
     """
     
-    global starting_words, word_dicts
-    
-    # If first is an empty or terminal string, add second as a starting word
-    if first is '' or is_terminal(first):
-        if second not in starting_words:
-            starting_words.append(second)
+    # If first is empty, second starts a sentence
+    if len(first) == 0:
+        word_data.add_starting_word(second)
         return
     
     # Add/increment the pair
-    if first in word_dicts:
-        if second in word_dicts[first]:
-            # If this pair already exists, increment
-            word_dicts[first][second] += 1
-        else:
-            # If this latter half of the pair doesn't exist, start it at 1
-            word_dicts[first][second] = 1
-    else:
-        # If neither part of this word pair exists, start it at 1
-        word_dicts[first] = {second: 1}
+    word_data.add_pair(first, second)
 
 
-def construct_dicts():
+def construct_dicts(processes=1):
     """Read through input files to train the program on word relationships
+    
+    :param processes: How many worker processes to train with, or None to
+    use one per CPU. More than one splits the files into chunks of
+    paragraphs (see train_in_parallel)
+    """
+    
+    if processes == 1:
+        # Open each file to read line-by-line, word-by-word
+        for file_name in FILES:
+            with open(file_name, 'r', encoding=ENCODING) as f:
+                train(f)
+    else:
+        train_in_parallel(processes)
+    
+    # Pack the counts into the sampling tables
+    word_data.freeze()
+
+
+def train(lines, tokenize=None):
+    """Add the word pairs in some lines of text to the Markov chain data
+    
+    Sentences carry on across lines and end at a blank line or after their
+    terminal punctuation, along with any more terminal punctuation or closing
+    quotes and brackets straight after it (see closes_sentence). Punctuation
+    at the start of a sentence, like an opening quote, is skipped so that
+    every starting word is a word.
+    
+    This updates word_data in place, whether it was trained or loaded, and
+    costs time proportional to the new text. The states it changes get new
+    sampling tables the next time they are sampled; call word_data.freeze()
+    to pack everything back into the compact tables.
+    
+    :param lines: An iterable of lines of text
+    :param tokenize: Function splitting a line into tokens (TOKENIZER by
+    default)
+    """
+    
+    if tokenize is None:
+        tokenize = TOKENIZER
+    
+    # Previous words (in this sentence), and whether it has reached its
+    # terminal punctuation
+    last_words = ()
+    ending = False
+    for line in lines:
+        tokens = tokenize(line)
+        
+        # A blank line ends the sentence
+        if len(tokens) == 0:
+            last_words = ()
+            ending = False
+            continue
+        
+        for word in tokens:
+            # Start over once the sentence's closing punctuation has run out
+            if ending and not closes_sentence(word):
+                last_words = ()
+                ending = False
+            
+            # Don't start sentences with punctuation
+            if len(last_words) == 0 and tokenizers.is_punctuation(word):
+                continue
+            
+            add_pair_to_dict(last_words, word)
+            last_words = (last_words + (word,))[-word_data.order:]
+            ending = ending or is_terminal(word)
+
+
+def train_in_parallel(processes=None, chunk_size=CHUNK_SIZE, tokenize=None):
+    """Count word pairs in chunks of the input files across worker processes
+    
+    Each worker trains its own WordData on one chunk. Chunks end at blank
+    lines, where sentences end anyway. As trained chunks come back in file
+    order, neighboring parts of the same size (one chunk, two chunks, four
+    chunks, ...) are merged by the workers, like adding one to a binary
+    counter. Once every chunk is in, the parts left are merged pairwise by
+    the workers until two are left, and those are merged into word_data.
+    Merging always keeps file order, which gives exactly the same model as
+    training serially.
+    
+    Only TRAINING_WINDOW chunks per process are trained at a time, and the
+    parts held at once are a few of each size, each size covering twice the
+    text of the one below. So however big the corpus, the parent holds the
+    window of chunk models and parts adding up to about one full model,
+    rather than a model for every chunk.
+    
+    :param processes: How many worker processes to use, or None to use one
+    per CPU
+    :param chunk_size: Approximate number of bytes of text per chunk
+    :param tokenize: Function splitting a line into tokens (TOKENIZER by
+    default), which must be defined at the top level of a module
+    """
+    
+    if tokenize is None:
+        tokenize = TOKENIZER
+    if processes is None:
+        processes = os.cpu_count() or 1
+    
+    tasks = (
+        (file_name, start, end, word_data.order, tokenize)
+        for file_name in FILES
+        for start, end in file_chunks(file_name, chunk_size)
+    )
+    
+    with multiprocessing.Pool(processes) as pool:
+        # Chunks being trained, oldest first
+        training = deque()
+        for task in itertools.islice(tasks, TRAINING_WINDOW * processes):
+            training.append(pool.apply_async(train_chunk, (task,)))
+        
+        # Trained parts of the text in file order, as [size, result]
+        parts = []
+        while len(training) > 0:
+            result = training.popleft()
+            result.wait()
+            task = next(tasks, None)
+            if task is not None:
+                training.append(pool.apply_async(train_chunk, (task,)))
+            
+            parts.append([1, result])
+            merge_parts(pool, parts)
+        
+        # Merge what's left pairwise, whatever the sizes, until two parts
+        # remain
+        while len(parts) > 2:
+            for part in parts:
+                part[1].wait()
+                part[0] = 1
+            merge_parts(pool, parts)
+        results = [result.get() for size, result in parts]
+    
+    for chunk_data in results:
+        word_data.merge(chunk_data)
+
+
+def merge_parts(pool, parts):
+    """Start merging neighboring trained parts of the same size
+    
+    Parts still being merged are left until a later call.
+    
+    :param pool: The pool to merge in
+    :param parts: The trained parts of the text in file order, as
+    [size, AsyncResult of the WordData], updated in place
+    """
+    
+    i = len(parts) - 1
+    while i > 0:
+        (size, first), (next_size, second) = parts[i - 1], parts[i]
+        if size == next_size and first.ready() and second.ready():
+            merged = pool.apply_async(merge_chunks,
+                                      ((first.get(), second.get()),))
+            parts[i - 1:i + 1] = [[2 * size, merged]]
+            i = min(i, len(parts)) - 1
+        else:
+            i -= 1
+
+
+def file_chunks(file_name, chunk_size):
+    """Split a file into byte ranges that each end after a blank line
+    
+    :param file_name: The file to split
+    :param chunk_size: Approximate number of bytes per range
+    :return: A list of (start, end) byte offsets
     """
     
-    global word_dicts
+    chunks = []
+    with open(file_name, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < size:
+            # Jump ahead and finish the paragraph we land in
+            f.seek(start + chunk_size)
+            f.readline()
+            line = f.readline()
+            while line.strip() != b'':
+                line = f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
     
-    # Open each file to read line-by-line, word-by-word
-    for file_name in FILES:
-        with open(file_name, 'r') as f:
-            for line in f:
-                # Previous word (in this line)
-                last_word = ''
-                for word in line.split():
-                    add_pair_to_dict(last_word, word)
-                    last_word = word
+    return chunks
 
 
-def get_next_word(last_word):
-    """Using weightings in dictionaries, randomly select the next word
+def train_chunk(task):
+    """Train a fresh WordData on one chunk of a file (in a worker process)
     
-    :param last_word: The prior word to use to when selecting the next word
-    :return: The next word
-    :raises Exception: If something goes wrong when computing probabilities of
-    the next word, raise an exception
+    :param task: The file name, start and end byte offsets, chain order and
+    tokenizer
+    :return: The trained, unfrozen WordData
     """
     
-    # Count up the number of possible words, including repeats
-    num_choices = 0
-    if last_word in word_dicts:
-        for word in word_dicts[last_word]:
-            num_choices += word_dicts[last_word][word]
+    global word_data
     
-    # Return empty string if no valid choice
-    if num_choices == 0:
-        return ''
+    file_name, start, end, order, tokenize = task
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start)
     
-    # Pick a random value for the word
-    rand = random.random()
-    cumulative_prob = 0
+    # Workers have their own copy of the module, so train its word_data
+    word_data = WordData(order)
+    train(io.TextIOWrapper(io.BytesIO(text), encoding=ENCODING), tokenize)
+    return word_data
+
+
+def merge_chunks(pair):
+    """Merge two neighboring chunks' WordData (in a worker process)
     
-    # Add up the cumulative probability (from 0 to 1) and return the current
-    # when reaching the random value in the cumulative probability
-    for word in word_dicts[last_word]:
-        cumulative_prob += word_dicts[last_word][word] / num_choices
-        if rand < cumulative_prob:
-            return word
+    :param pair: The earlier chunk's WordData and the later one's
+    :return: The earlier WordData with the later merged into it
+    """
     
-    # Probabilities didn't accumulate to one
-    raise Exception('Probabilities for next word did not accumulate to 1.')
+    first, second = pair
+    first.merge(second)
+    return first
 
 
-def string_from_dicts(sep=' '):
+def get_next_word(last_words):
+    """Using weightings in the frozen tables, randomly select the next word
+    
+    Backs off to fewer previous words if the full state was never seen.
+    
+    :param last_words: The prior words (oldest first) to use when selecting
+    the next word
+    :return: The next word, or an empty string if there is no valid choice
+    """
+    
+    return word_data.next_word(last_words)
+
+
+def string_from_dicts(sep=' ', rng=random, data=None):
     """Returns a string created from the Markov chain input data
     
     The string is terminated when it reaches a terminal case i.e.
-    is_terminal(string)).
+    is_terminal(string)). Only the newest word is checked each step, so
+    building a string takes time linear in its length.
     
+    :param sep: The separator to put between words
+    :param rng: The random number generator to draw from
+    :param data: The WordData to generate from (word_data by default)
     :return: The generated string after meeting some termination case
     """
     
+    if data is None:
+        data = word_data
+    
     # Get random starting word and begin string with it
-    starting_word_id = random.randint(0, len(starting_words) - 1)
-    last_word = starting_words[starting_word_id]
-    string = last_word.capitalize()
+    words = data.words
+    last_ids = [data.random_starting_id(rng)]
+    word = words[last_ids[0]]
+    tokens = [word.capitalize()]
     
-    while not is_terminal(string) and last_word is not '':
-        string += sep
-        next_word = get_next_word(last_word)
-        string += next_word
-        last_word = next_word
+    while not is_terminal(word) and len(tokens) < MAX_WORDS:
+        next_id = data.next_id(last_ids, rng)
+        if next_id < 0:
+            break
+        
+        word = words[next_id]
+        tokens.append(word)
+        last_ids.append(next_id)
+        del last_ids[:-data.order]
     
-    return string
+    return tokenizers.join_tokens(tokens, sep)
+
+
+def generate_batch(n, seed=None, sep=' ', data=None):
+    """Generate many strings at once from the Markov chain input data
+    
+    Each batch draws from its own random number generator, so batches can be
+    generated side by side from one shared WordData.
+    
+    :param n: How many strings to generate
+    :param seed: Seed for the batch's random number generator, so the same
+    seed always gives the same batch (random by default)
+    :param sep: The separator to put between words
+    :param data: The WordData to generate from (word_data by default)
+    :return: A list of n generated strings
+    """
+    
+    rng = random.Random(seed)
+    return [string_from_dicts(sep, rng, data) for i in range(n)]
 
 
 def is_terminal(string):
@@ -133,20 +358,100 @@ def is_terminal(string):
         return True
     
     # Check for too many words
-    if len(string.split()) >= 100:
+    if len(string.split()) >= MAX_WORDS:
         return True
     
     return False
 
 
+def closes_sentence(word):
+    """Check if a word after a sentence's terminal punctuation still belongs
+    to that sentence, like the "!" of "?!" or a closing quote
+    
+    :param word: The word following the terminal punctuation
+    :return: True if the word is more terminal punctuation or a closing
+    quote or bracket, False if it starts the next sentence
+    """
+    
+    if not tokenizers.is_punctuation(word):
+        return False
+    
+    return is_terminal(word) or word in CLOSING_PUNCTUATION
+
+
+def save_dicts(path):
+    """Write the trained Markov chain data to a binary model file
+    
+    :param path: The file to write
+    """
+    
+    word_data.save(path)
+
+
+def load_dicts(path):
+    """Replace the Markov chain data with a model file written by save_dicts
+    
+    The file is memory-mapped rather than read, so this is nearly instant
+    and processes loading the same file share one copy of it.
+    
+    :param path: The file to read
+    """
+    
+    global word_data
+    
+    word_data = WordData.load(path)
+
+
+def printhelp():
+    # Print basic usage
+    print('\nUsage:  MarkovWords.py [-h] [-wm FILE] [-rm FILE]\n')
+    
+    # Print description of each option
+    print('[' + OPTIONS[0] + ']\t\tDisplay this help message')
+    print('[' + OPTIONS[1] + ' FILE]\tWrite the trained model to a given file')
+    print('[' + OPTIONS[2] + ' FILE]\tRead the model from a given file '
+                             'instead of training')
+
+
 def main():
-    """Train the Markov chain and produce output from it
+    """Train (or load) the Markov chain and produce output from it
     """
     
-    construct_dicts()
+    # Initialize variables for storing the model
+    in_model_path = ''
+    out_model_path = ''
+    
+    # Iterate over command line arguments
+    argv = ''
+    for i in range(1, len(sys.argv)):
+        # Get argument and potential option flag
+        prev = argv
+        argv = sys.argv[i]
+        
+        if argv == '-h':
+            # Display usage information
+            printhelp()
+            exit(0)
+        elif argv in OPTIONS:
+            continue
+        elif prev == '-wm':
+            # Set the output model filepath
+            out_model_path = argv
+        elif prev == '-rm':
+            # Set the input model filepath
+            in_model_path = argv
+    
+    # Train or load the model
+    if in_model_path:
+        load_dicts(in_model_path)
+    else:
+        construct_dicts()
+    
+    # Write the model
+    if out_model_path:
+        save_dicts(out_model_path)
     
-    for i in range(10):
-        print(string_from_dicts())
+    print('\n'.join(generate_batch(10)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,418 @@
+# Author
+# William Lucca
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import MarkovWords
+import tokenizers
+import word_server
+from word_data import WordData
+
+# Benchmark settings
+NUM_WORDS = 200000
+NUM_STRINGS = 5000
+ORDERS = [1, 2, 3, 4]
+DELTA_LINES = 100
+TOKENIZERS = [tokenizers.split_tokens, tokenizers.regex_tokens,
+              tokenizers.folded_tokens]
+TOKENIZE_PASSES = 10
+SERVER_CLIENTS = 16
+SERVER_REQUESTS = 1000
+PROCESS_COUNTS = [1, 2, 4, 8]
+TRAINING_COPIES = 32
+TRAINING_CHUNK_SIZE = 1024 * 1024
+
+
+def legacy_train():
+    """Train the original dict-of-dicts model keyed by word strings
+
+    :return: The starting words list and the word pair dicts
+    """
+
+    starting_words = []
+    word_dicts = {}
+    for file_name in MarkovWords.FILES:
+        with open(file_name, 'r') as f:
+            for line in f:
+                last_word = ''
+                for word in line.split():
+                    if last_word == '' or MarkovWords.is_terminal(last_word):
+                        if word not in starting_words:
+                            starting_words.append(word)
+                    else:
+                        seconds = word_dicts.setdefault(last_word, {})
+                        seconds[word] = seconds.get(word, 0) + 1
+                    last_word = word
+    return starting_words, word_dicts
+
+
+def legacy_next_word(word_dicts, last_word):
+    """The original get_next_word: sum the counts, then walk them again
+
+    :param word_dicts: The word pair dicts from legacy_train()
+    :param last_word: The prior word to use to when selecting the next word
+    :return: The next word
+    """
+
+    seconds = word_dicts.get(last_word)
+    if not seconds:
+        return ''
+
+    num_choices = 0
+    for word in seconds:
+        num_choices += seconds[word]
+
+    rand = random.random()
+    cumulative_prob = 0
+    for word in seconds:
+        cumulative_prob += seconds[word] / num_choices
+        if rand < cumulative_prob:
+            return word
+    return word
+
+
+def measure(train):
+    """Run a training function, timing it and tracing its memory
+
+    :param train: Function that builds and returns a model
+    :return: The model, the seconds taken and the bytes still allocated
+    """
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = train()
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return model, seconds, size
+
+
+def words_per_second(next_word, starting_words, num_words):
+    """Time a next-word function over a long random walk of the chain
+
+    The walk restarts from a random starting word whenever it dead-ends, so
+    both models see the same mix of common and rare words.
+
+    :param next_word: Function mapping a word to a randomly chosen next word
+    :param starting_words: Sequence of words to restart the walk from
+    :param num_words: How many words to generate
+    :return: The number of words generated per second
+    """
+
+    random.seed(0)
+    word = ''
+    start = time.perf_counter()
+    for i in range(num_words):
+        if word == '':
+            word = random.choice(starting_words)
+        word = next_word(word)
+    return num_words / (time.perf_counter() - start)
+
+
+def train_word_data(order=1, tokenize=tokenizers.split_tokens):
+    """Train the interned, array-backed model the way MarkovWords does
+
+    Training uses the whitespace tokenizer unless told otherwise, so the
+    numbers compare with the original model.
+    """
+
+    MarkovWords.ORDER = order
+    MarkovWords.TOKENIZER = tokenize
+    MarkovWords.word_data = WordData(order)
+    MarkovWords.construct_dicts()
+    return MarkovWords.word_data
+
+
+def chain_words_per_second(data, num_words):
+    """Time a random walk of an order-N chain, keeping the last N word ids
+
+    :param data: A trained and frozen WordData
+    :param num_words: How many words to generate
+    :return: The number of words generated per second
+    """
+
+    random.seed(0)
+    ids = []
+    start = time.perf_counter()
+    for i in range(num_words):
+        if len(ids) == 0:
+            ids = [random.choice(data.starting_ids)]
+        next_id = data.next_id(ids)
+        if next_id < 0:
+            ids = []
+        else:
+            ids.append(next_id)
+            del ids[:-data.order]
+    return num_words / (time.perf_counter() - start)
+
+
+def compare_models():
+    """Compare the original model with WordData on the bundled script
+    """
+
+    (starts, dicts), legacy_secs, legacy_size = measure(legacy_train)
+    data, data_secs, data_size = measure(train_word_data)
+
+    print('%-18s %10s %12s %14s' % ('', 'train (s)', 'memory (KB)',
+                                    'words/s'))
+    legacy_rate = words_per_second(
+            lambda word: legacy_next_word(dicts, word), starts, NUM_WORDS)
+    print('%-18s %10.3f %12.0f %14.0f' % ('dict of dicts', legacy_secs,
+                                          legacy_size / 1024, legacy_rate))
+    start_words = [data.words[i] for i in data.starting_ids]
+    data_rate = words_per_second(lambda word: data.next_word((word,)),
+                                 start_words, NUM_WORDS)
+    print('%-18s %10.3f %12.0f %14.0f' % ('WordData (CSR)', data_secs,
+                                          data_size / 1024, data_rate))
+
+
+def compare_orders():
+    """Compare memory and generation speed of chains of different orders
+    """
+
+    print('%-6s %10s %10s %12s %14s' % ('order', 'states', 'train (s)',
+                                        'memory (KB)', 'words/s'))
+    for order in ORDERS:
+        data, secs, size = measure(lambda: train_word_data(order))
+        rate = chain_words_per_second(data, NUM_WORDS)
+        print('%-6d %10d %10.3f %12.0f %14.0f' % (order, data.num_nodes, secs,
+                                                  size / 1024, rate))
+
+
+def compare_training():
+    """Compare serial training with parallel training on more processes
+
+    The bundled script is repeated TRAINING_COPIES times to make a corpus
+    big enough to split into chunks.
+    """
+
+    files = MarkovWords.FILES
+    MarkovWords.FILES = files * TRAINING_COPIES
+    size = sum(os.path.getsize(file_name) for file_name in MarkovWords.FILES)
+
+    print('%-10s %10s %12s' % ('processes', 'train (s)', 'MB/s'))
+    for processes in PROCESS_COUNTS:
+        MarkovWords.word_data = WordData()
+        start = time.perf_counter()
+        if processes == 1:
+            MarkovWords.construct_dicts()
+        else:
+            MarkovWords.train_in_parallel(processes, TRAINING_CHUNK_SIZE)
+            MarkovWords.word_data.freeze()
+        secs = time.perf_counter() - start
+        print('%-10d %10.3f %12.2f' % (processes, secs, size / secs / 1e6))
+
+    MarkovWords.FILES = files
+
+
+def legacy_string(sep=' '):
+    """The original string_from_dicts: concatenate, re-checking the string"""
+
+    last_word = MarkovWords.word_data.random_starting_word()
+    last_words = (last_word,)
+    string = last_word.capitalize()
+    while not MarkovWords.is_terminal(string) and last_word != '':
+        string += sep
+        next_word = MarkovWords.get_next_word(last_words)
+        string += next_word
+        last_word = next_word
+        last_words = (last_words + (next_word,))[-MarkovWords.ORDER:]
+    return string
+
+
+def compare_generation():
+    """Compare building strings one at a time with generate_batch()
+    """
+
+    train_word_data()
+
+    random.seed(0)
+    start = time.perf_counter()
+    for i in range(NUM_STRINGS):
+        legacy_string()
+    before = NUM_STRINGS / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    MarkovWords.generate_batch(NUM_STRINGS, seed=0)
+    after = NUM_STRINGS / (time.perf_counter() - start)
+
+    print('%-22s %12s' % ('generation', 'strings/s'))
+    print('%-22s %12.0f' % ('concatenate + split', before))
+    print('%-22s %12.0f' % ('generate_batch', after))
+
+
+def compare_startup():
+    """Compare starting up by retraining with mapping a saved model file
+    """
+
+    start = time.perf_counter()
+    data = train_word_data()
+    train_secs = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.mkvw')
+        data.save(path)
+        size = os.path.getsize(path)
+
+        start = time.perf_counter()
+        MarkovWords.load_dicts(path)
+        MarkovWords.string_from_dicts()
+        load_secs = time.perf_counter() - start
+        MarkovWords.word_data = data
+
+    print('%-22s %10s' % ('startup', 'seconds'))
+    print('%-22s %10.4f' % ('retrain', train_secs))
+    print('%-22s %10.4f' % ('mmap load (%d KB)' % (size // 1024), load_secs))
+
+
+def compare_incremental():
+    """Compare retraining from scratch with training a small delta in place
+
+    The base model is trained on all but the last DELTA_LINES lines of the
+    script. Both timings include generating a batch of strings afterwards,
+    so the incremental one pays for rebuilding the changed states' tables.
+    """
+
+    with open(MarkovWords.FILES[0], 'r', encoding=MarkovWords.ENCODING) as f:
+        lines = f.readlines()
+
+    MarkovWords.word_data = WordData()
+    MarkovWords.train(lines[:-DELTA_LINES])
+    MarkovWords.word_data.freeze()
+
+    start = time.perf_counter()
+    MarkovWords.train(lines[-DELTA_LINES:])
+    MarkovWords.generate_batch(100, seed=0)
+    delta_secs = time.perf_counter() - start
+    num_changed = len(MarkovWords.word_data.counts)
+
+    start = time.perf_counter()
+    train_word_data()
+    MarkovWords.generate_batch(100, seed=0)
+    full_secs = time.perf_counter() - start
+
+    print('%-28s %10s' % ('update', 'seconds'))
+    print('%-28s %10.4f' % ('retrain everything', full_secs))
+    print('%-28s %10.4f' % ('train %d lines (%d states)'
+                            % (DELTA_LINES, num_changed), delta_secs))
+
+
+async def server_client(path, num_requests, latencies):
+    """Send requests one after another over one keep-alive connection"""
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    for i in range(num_requests):
+        start = time.perf_counter()
+        writer.write(b'GET /generate?n=1&seed=%d HTTP/1.1\r\n\r\n' % i)
+        length = 0
+        while True:
+            header = await reader.readline()
+            if header == b'\r\n':
+                break
+            if header.lower().startswith(b'content-length:'):
+                length = int(header.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def load_test(path):
+    """Run a WordServer on a Unix socket and hit it with parallel clients
+
+    :param path: The socket path to serve on
+    :return: Sorted client-side latencies, the total seconds taken and the
+    server's own stats
+    """
+
+    server = word_server.WordServer(MarkovWords.word_data)
+    serving = asyncio.ensure_future(server.serve(unix_path=path))
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[server_client(path, SERVER_REQUESTS, latencies)
+                           for i in range(SERVER_CLIENTS)])
+    secs = time.perf_counter() - start
+
+    serving.cancel()
+    return sorted(latencies), secs, server.stats()
+
+
+def compare_server():
+    """Load test the generation server, with clients in the same process
+
+    The clients share the CPU with the server, so the request rate is a
+    lower bound for a server with a core to itself.
+    """
+
+    train_word_data()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'words.sock')
+        latencies, secs, stats = asyncio.run(load_test(path))
+
+    print('%-22s %12s %10s %10s' % ('server', 'requests/s', 'p50 (ms)',
+                                    'p99 (ms)'))
+    print('%-22s %12.0f %10.3f %10.3f' % (
+            'client round trip', len(latencies) / secs,
+            1000 * word_server.percentile(latencies, 50),
+            1000 * word_server.percentile(latencies, 99)))
+    print('%-22s %12s %10.3f %10.3f' % ('server request', '',
+                                        stats['p50_ms'], stats['p99_ms']))
+    print('%-22s %12s %10.3f %10.3f' % ('server handler', '',
+                                        stats['handler_p50_ms'],
+                                        stats['handler_p99_ms']))
+
+
+def compare_tokenizers():
+    """Compare tokenizer speed and the size of the order-2 model each gives
+    """
+
+    with open(MarkovWords.FILES[0], 'r', encoding=MarkovWords.ENCODING) as f:
+        lines = f.readlines()
+
+    print('%-16s %14s %10s %10s' % ('tokenizer', 'tokens/s', 'words',
+                                    'states'))
+    for tokenize in TOKENIZERS:
+        num_tokens = 0
+        start = time.perf_counter()
+        for i in range(TOKENIZE_PASSES):
+            for line in lines:
+                num_tokens += len(tokenize(line))
+        rate = num_tokens / (time.perf_counter() - start)
+
+        data = train_word_data(2, tokenize)
+        print('%-16s %14.0f %10d %10d' % (tokenize.__name__, rate,
+                                          len(data.words), data.num_nodes))
+
+    MarkovWords.TOKENIZER = tokenizers.regex_tokens
+
+
+def main():
+    """Run every benchmark on the bundled script
+    """
+
+    compare_models()
+    print()
+    compare_orders()
+    print()
+    compare_training()
+    print()
+    compare_startup()
+    print()
+    compare_generation()
+    print()
+    compare_incremental()
+    print()
+    compare_server()
+    print()
+    compare_tokenizers()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Author
+# William Lucca
+
+import re
+
+# Words (keeping inner apostrophes and hyphens), ellipses, or any other
+# single non-space character as a punctuation token
+TOKEN_REGEX = re.compile(r"\w+(?:['-]\w+)*|\.\.\.|[^\w\s]")
+
+# Punctuation tokens written straight after the token before them, and
+# tokens written straight before the token after them
+ATTACH_LEFT = re.compile(r"\.\.\.|[.,!?;:)\]}]")
+ATTACH_RIGHT = re.compile(r"[(\[{]")
+
+# Tokens made only of punctuation
+PUNCTUATION_REGEX = re.compile(r"[^\w\s]+")
+
+# Quote mark that opens and closes quotes in turn when joining tokens
+QUOTE = '"'
+
+
+def split_tokens(line):
+    """Split a line on whitespace only, so punctuation stays on its word
+
+    :param line: The line of text to tokenize
+    :return: The list of tokens
+    """
+
+    return line.split()
+
+
+def regex_tokens(line):
+    """Split a line into words and separate punctuation tokens
+
+    :param line: The line of text to tokenize
+    :return: The list of tokens
+    """
+
+    return TOKEN_REGEX.findall(line)
+
+
+def folded_tokens(line):
+    """Split a case-folded line into words and separate punctuation tokens
+
+    :param line: The line of text to tokenize
+    :return: The list of tokens
+    """
+
+    return TOKEN_REGEX.findall(line.casefold())
+
+
+def is_punctuation(token):
+    """Check if a token is made only of punctuation, like "?!" or an opening
+    quote
+
+    :param token: The token to check
+    :return: True if the token has no letters, digits or spaces
+    """
+
+    return PUNCTUATION_REGEX.fullmatch(token) is not None
+
+
+def join_tokens(tokens, sep=' '):
+    """Join tokens back into text, without separators around punctuation
+
+    Quote marks take turns opening a quote, attached to the token after, and
+    closing it, attached to the token before. A quote mark at the very end
+    always closes, and a quote still open at the end is closed.
+
+    :param tokens: The tokens to join
+    :param sep: The separator to put between words
+    :return: The joined string
+    """
+
+    parts = []
+    attach = True
+    quoted = False
+    for i, token in enumerate(tokens):
+        if token == QUOTE:
+            closing = quoted or i == len(tokens) - 1
+            quoted = not closing
+            attach_left = closing
+            attach_right = not closing
+        else:
+            attach_left = ATTACH_LEFT.fullmatch(token) is not None
+            attach_right = ATTACH_RIGHT.fullmatch(token) is not None
+
+        if not attach and not attach_left:
+            parts.append(sep)
+        parts.append(token)
+        attach = attach_right
+
+    if quoted:
+        parts.append(QUOTE)
+
+    return ''.join(parts)
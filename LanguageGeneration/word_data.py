@@ -0,0 +1,537 @@
+# Author
+# William Lucca
+
+import mmap
+import random
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Binary model file layout: magic, version, order, then the section sizes
+FILE_MAGIC = b'MKVW'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sII4x6Q')
+
+
+class WordData:
+    """Order-N word Markov chain stored as interned ids and compressed arrays
+
+    Words are interned into integer ids as they are seen. States (the last
+    one to N words) live in a trie keyed on the most recent word first, so
+    the state for (w1, w2) is the child w1 of the state for (w2,). Every
+    order shares the nodes of its shorter suffixes, and backing off to a
+    lower order is just stopping higher up the trie.
+
+    Counts are gathered in small per-node dicts while training, then freeze()
+    packs them into compressed sparse row (CSR) arrays: the following words
+    of node n are successors[offsets[n]:offsets[n + 1]], with the running
+    count totals for that row in the matching slice of cumulative. Trie
+    edges are frozen into a sorted key array and a matching node array.
+
+    The frozen arrays can be written to a binary file with save() and mapped
+    back into memory with load(), without copying or parsing them.
+    """
+
+    def __init__(self, order=1):
+        """Creates an empty WordData
+
+        :param order: The number of previous words a state is made of
+        """
+
+        self.order = order
+
+        # Vocabulary interning table
+        self.words = []
+        self._word_ids = dict()
+
+        # Starting word ids in order of appearance, plus a set for lookups
+        self.starting_ids = array('I')
+        self.starting_set = set()
+
+        # State trie, with edges keyed by (node << 32) | word id. Node 0 is
+        # the root, the empty state, which never has following words. New
+        # edges go in children until freeze() moves them to the arrays
+        self.children = dict()
+        self.edge_keys = array('Q')
+        self.edge_nodes = array('I')
+        self.num_nodes = 1
+
+        # Counts that have not been frozen yet, keyed by node then word id
+        self.counts = dict()
+
+        # Sampling tables for nodes with counts that are not frozen yet,
+        # built when first sampled and dropped when the node's counts change
+        self.tables = dict()
+
+        # Frozen CSR tables
+        self.offsets = array('Q', [0])
+        self.successors = array('I')
+        self.cumulative = array('Q')
+
+        # Memory map backing the arrays of a loaded model
+        self._mmap = None
+
+    @property
+    def word_ids(self):
+        """Lookup table from word to id, built on first use after a load"""
+
+        if self._word_ids is None:
+            self._word_ids = {word: i for i, word in enumerate(self.words)}
+        return self._word_ids
+
+    def intern(self, word):
+        """Get the id of a word, adding it to the vocabulary if it is new"""
+
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            # The vocabulary of a loaded model is read-only, so copy it
+            if not isinstance(self.words, list):
+                self.words = list(self.words)
+
+            word_id = len(self.words)
+            self.word_ids[word] = word_id
+            self.words.append(word)
+        return word_id
+
+    def add_starting_word(self, word):
+        """Mark a word as one that can begin a string"""
+
+        self.add_starting_id(self.intern(word))
+
+    def add_starting_id(self, word_id):
+        """Mark a word id as one that can begin a string"""
+
+        if word_id not in self.starting_set:
+            # The starting ids of a loaded model are read-only, so copy them
+            if isinstance(self.starting_ids, memoryview):
+                self.starting_ids = array('I', self.starting_ids)
+
+            self.starting_set.add(word_id)
+            self.starting_ids.append(word_id)
+
+    def child(self, node, word_id):
+        """Get the trie node below node for word_id, or -1 if there is none"""
+
+        if word_id < 0:
+            return -1
+
+        key = (node << 32) | word_id
+        keys = self.edge_keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return self.edge_nodes[i]
+        return self.children.get(key, -1) if self.children else -1
+
+    def add_child(self, node, word_id):
+        """Get the trie node below node for word_id, creating it if needed"""
+
+        child = self.child(node, word_id)
+        if child < 0:
+            key = (node << 32) | word_id
+            child = self.num_nodes
+            self.children[key] = child
+            self.num_nodes += 1
+        return child
+
+    def add_pair(self, first, second, count=1):
+        """Add to the count of second following the words in first
+
+        Every state from the last word alone up to the last order words is
+        counted, so lower orders are there to back off to.
+
+        :param first: The preceding words, oldest first
+        :param second: The following word
+        :param count: How many times to count the pair
+        """
+
+        second_id = self.intern(second)
+
+        node = 0
+        for word in reversed(first[-self.order:]):
+            node = self.add_child(node, self.intern(word))
+
+            seconds = self.counts.get(node)
+            if seconds is None:
+                self.counts[node] = {second_id: count}
+            else:
+                seconds[second_id] = seconds.get(second_id, 0) + count
+
+            # This node's sampling table is out of date now
+            if self.tables:
+                self.tables.pop(node, None)
+
+    def merge(self, other):
+        """Add everything another WordData was trained on into this one
+
+        Words, starting words and trie nodes new to this WordData are added
+        in the order other first saw them, so training on a text in pieces
+        and merging the pieces in order gives the same ids as training on
+        the whole text at once.
+
+        :param other: A WordData of the same order
+        """
+
+        # Map other's word ids to ours
+        ids = [self.intern(word) for word in other.words]
+        for word_id in other.starting_ids:
+            self.add_starting_id(ids[word_id])
+
+        # Map other's nodes to ours in the order other created them, which
+        # always puts a parent before its children
+        nodes = [0] * other.num_nodes
+        edges = list(zip(other.edge_keys, other.edge_nodes))
+        edges.extend(other.children.items())
+        for key, child in sorted(edges, key=lambda edge: edge[1]):
+            nodes[child] = self.add_child(nodes[key >> 32],
+                                          ids[key & 0xFFFFFFFF])
+
+        # Add both the frozen and the pending counts
+        for node in range(other.num_nodes):
+            pairs = list(other.counts.get(node, {}).items())
+            if node < len(other.offsets) - 1:
+                pairs.extend(other.row_counts(node))
+            if len(pairs) == 0:
+                continue
+
+            seconds = self.counts.setdefault(nodes[node], dict())
+            self.tables.pop(nodes[node], None)
+            for second_id, count in pairs:
+                second_id = ids[second_id]
+                seconds[second_id] = seconds.get(second_id, 0) + count
+
+    def freeze(self):
+        """Pack the pending pair counts into the CSR sampling tables
+
+        Rows that are already frozen are merged with any new counts, so this
+        can be called again after more training. Following words are sorted
+        by id within each row.
+        """
+
+        # Nothing to do if nothing has been added since the last freeze
+        if (len(self.counts) == 0 and len(self.children) == 0
+                and self.num_nodes == len(self.offsets) - 1):
+            return
+
+        # Move new trie edges into the sorted edge arrays
+        if len(self.children) > 0:
+            edges = sorted(list(zip(self.edge_keys, self.edge_nodes)) +
+                           list(self.children.items()))
+            self.edge_keys = array('Q', [key for key, node in edges])
+            self.edge_nodes = array('I', [node for key, node in edges])
+            self.children = dict()
+
+        offsets = array('Q', [0])
+        successors = array('I')
+        cumulative = array('Q')
+        num_frozen = len(self.offsets) - 1
+
+        for node in range(self.num_nodes):
+            seconds = self.counts.get(node)
+
+            if node < num_frozen:
+                lo = self.offsets[node]
+                hi = self.offsets[node + 1]
+                if seconds is None:
+                    # Untouched row, copy it over as-is
+                    successors.extend(self.successors[lo:hi])
+                    cumulative.extend(self.cumulative[lo:hi])
+                    offsets.append(len(successors))
+                    continue
+
+                # Fold the frozen counts into the new ones
+                seconds = dict(seconds)
+                for second_id, count in self.row_counts(node):
+                    seconds[second_id] = seconds.get(second_id, 0) + count
+
+            total = 0
+            for second_id, count in sorted((seconds or {}).items()):
+                total += count
+                successors.append(second_id)
+                cumulative.append(total)
+            offsets.append(len(successors))
+
+        self.offsets = offsets
+        self.successors = successors
+        self.cumulative = cumulative
+        self.counts = dict()
+        self.tables = dict()
+
+    def row_counts(self, node):
+        """Get (following id, count) pairs from the frozen row of a node"""
+
+        lo = self.offsets[node]
+        hi = self.offsets[node + 1]
+        prev_total = 0
+        for i in range(lo, hi):
+            yield self.successors[i], self.cumulative[i] - prev_total
+            prev_total = self.cumulative[i]
+
+    def state(self, ids):
+        """Find the longest known state for a sequence of previous word ids
+
+        :param ids: The previous word ids, oldest first
+        :return: The deepest trie node matching the end of ids, which is 0
+        (the root) if even the last word has never been followed
+        """
+
+        node = 0
+        for word_id in reversed(ids[-self.order:]):
+            child = self.child(node, word_id)
+            if child < 0:
+                break
+            node = child
+        return node
+
+    def table(self, node):
+        """Get the sampling table of a node with counts that are not frozen
+
+        The table merges the node's frozen row with its new counts and is
+        kept until the node is trained on again, so after some incremental
+        training only the states that changed are ever rebuilt.
+
+        :param node: A node in counts
+        :return: Lists of following word ids and their running count totals
+        """
+
+        table = self.tables.get(node)
+        if table is None:
+            seconds = dict(self.counts[node])
+            if node < len(self.offsets) - 1:
+                for second_id, count in self.row_counts(node):
+                    seconds[second_id] = seconds.get(second_id, 0) + count
+
+            successors = []
+            cumulative = []
+            total = 0
+            for second_id, count in sorted(seconds.items()):
+                total += count
+                successors.append(second_id)
+                cumulative.append(total)
+
+            table = (successors, cumulative)
+            self.tables[node] = table
+        return table
+
+    def next_id(self, ids, rng=random):
+        """Randomly pick the id of a word following the given word ids
+
+        Unseen states back off to the longest suffix of ids that was seen.
+
+        :param ids: The previous word ids, oldest first
+        :param rng: The random number generator to draw from
+        :return: The id of the next word, or -1 if there is no valid choice
+        """
+
+        node = self.state(ids)
+        if self.counts and node in self.counts:
+            # Trained since the last freeze, so use its own table
+            successors, cumulative = self.table(node)
+            lo = 0
+            hi = len(cumulative)
+        elif node < len(self.offsets) - 1:
+            successors = self.successors
+            cumulative = self.cumulative
+            lo = self.offsets[node]
+            hi = self.offsets[node + 1]
+        else:
+            return -1
+
+        if lo == hi:
+            return -1
+
+        # Pick a random point in the row's total count and bisect for it
+        rand = rng.random() * cumulative[hi - 1]
+        return successors[bisect_right(cumulative, rand, lo, hi)]
+
+    def next_word(self, words, rng=random):
+        """Randomly pick a word following the given words, or '' if none
+
+        :param words: The previous words, oldest first
+        :param rng: The random number generator to draw from
+        """
+
+        # Words never seen in training (id -1) cut the state off there
+        ids = [self.word_ids.get(word, -1) for word in words[-self.order:]]
+        next_id = self.next_id(ids, rng)
+        return self.words[next_id] if next_id >= 0 else ''
+
+    def random_starting_id(self, rng=random):
+        """Pick the id of a random starting word, each one equally likely"""
+
+        return self.starting_ids[rng.randrange(len(self.starting_ids))]
+
+    def random_starting_word(self, rng=random):
+        """Pick a random starting word, each one equally likely"""
+
+        return self.words[self.random_starting_id(rng)]
+
+    def save(self, path):
+        """Freeze the chain and write it to a binary model file
+
+        The file holds a header followed by the vocabulary and the frozen
+        arrays, little-endian and each aligned to 8 bytes so load() can map
+        them in place.
+
+        :param path: The file to write
+        """
+
+        self.freeze()
+
+        # Vocabulary as one UTF-8 blob plus the byte offset of each word
+        word_offsets = array('Q', [0])
+        blob = bytearray()
+        for word in self.words:
+            blob += word.encode('utf-8')
+            word_offsets.append(len(blob))
+
+        sections = [word_offsets, blob, self.starting_ids, self.edge_keys,
+                    self.edge_nodes, self.offsets, self.successors,
+                    self.cumulative]
+
+        with open(path, 'wb') as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, self.order,
+                                     len(self.words), len(blob),
+                                     len(self.starting_ids),
+                                     len(self.edge_keys), self.num_nodes,
+                                     len(self.successors)))
+            for section in sections:
+                data = to_little_endian(section)
+                f.write(data)
+                f.write(bytes(-len(data) % 8))
+
+    @classmethod
+    def load(cls, path):
+        """Map a model file written by save() into a new, frozen WordData
+
+        The arrays are read-only views of the mapped file, so loading does
+        not depend on the size of the model, and processes loading the same
+        file share it through the page cache. Training a loaded model more
+        copies whatever it changes.
+
+        :param path: The file to read
+        :return: The loaded WordData
+        :raises ValueError: If the file is not a model file this version of
+        WordData can read
+        """
+
+        not_model = ValueError('"%s" is not a version %d word model file'
+                               % (path, FILE_VERSION))
+
+        with open(path, 'rb') as f:
+            # Too short for a header, or empty, which can't be mapped
+            if len(f.read(FILE_HEADER.size)) < FILE_HEADER.size:
+                raise not_model
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped)
+        (magic, version, order, num_words, blob_size, num_starting,
+         num_edges, num_nodes, num_successors) = FILE_HEADER.unpack_from(view)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise not_model
+
+        data = cls(order)
+        data._mmap = mapped
+        pos = FILE_HEADER.size
+
+        def section(typecode, length):
+            nonlocal pos
+            itemsize = array(typecode).itemsize
+            start = pos
+            pos += length * itemsize
+            if pos > len(view):
+                # Truncated file
+                raise not_model
+            pos += -pos % 8
+            return from_little_endian(view[start:start + length * itemsize],
+                                      typecode)
+
+        word_offsets = section('Q', num_words + 1)
+        blob = section('B', blob_size)
+        data.words = MappedWords(word_offsets, blob)
+        data._word_ids = None
+
+        data.starting_ids = section('I', num_starting)
+        data.starting_set = set(data.starting_ids)
+        data.edge_keys = section('Q', num_edges)
+        data.edge_nodes = section('I', num_edges)
+        data.num_nodes = num_nodes
+        data.offsets = section('Q', num_nodes + 1)
+        data.successors = section('I', num_successors)
+        data.cumulative = section('Q', num_successors)
+
+        return data
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def __getstate__(self):
+        # Copy mapped arrays so the pickled model stands on its own
+        state = dict(self.__dict__)
+        state['_mmap'] = None
+        for name, value in state.items():
+            if isinstance(value, memoryview):
+                state[name] = array(value.format, value)
+        if isinstance(self.words, MappedWords):
+            state['words'] = list(self.words)
+        return state
+
+
+class MappedWords:
+    """Read-only sequence of the words in a loaded model's vocabulary
+
+    Words are decoded from the mapped UTF-8 blob when they are accessed.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode(
+                'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def to_little_endian(values):
+    """Get the bytes of an array, bytearray or memoryview in little-endian
+    order
+
+    This and from_little_endian are kept the same as the copies in
+    ImageGeneration/markov_data.py, since the two folders are run as separate
+    scripts and share no modules.
+    """
+
+    view = memoryview(values)
+    if sys.byteorder == 'little' or view.itemsize == 1:
+        return view.cast('B')
+
+    # Memoryviews of arrays and casts of them have the typecode as format
+    swapped = array(view.format, view.tobytes())
+    swapped.byteswap()
+    return memoryview(swapped).cast('B')
+
+
+def from_little_endian(data, typecode):
+    """View little-endian bytes as an array of typecode, copying only if the
+    machine is big-endian
+
+    :param data: A memoryview of the bytes
+    :param typecode: The array typecode of the values
+    :return: A read-only memoryview, or an array on big-endian machines
+    """
+
+    if sys.byteorder == 'little':
+        return data.cast(typecode)
+
+    values = array(typecode, data.tobytes())
+    values.byteswap()
+    return values
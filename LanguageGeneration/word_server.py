@@ -0,0 +1,272 @@
+# Author
+# William Lucca
+
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+import MarkovWords
+
+# Command line options
+OPTIONS = ['-h', '-rm', '-p', '-u']
+
+# Default settings
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+# Most strings one request can ask for
+MAX_BATCH = 1000
+
+# How many of the latest request latencies to keep for the stats
+LATENCY_WINDOW = 100000
+
+STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed'
+}
+
+
+class WordServer:
+    """HTTP server that generates strings from one shared, trained WordData
+
+    Requests are handled one at a time on the event loop and each batch gets
+    its own random number generator, so nothing is shared between requests
+    except the read-only model.
+
+    Endpoints:
+    GET /generate?n=N&seed=SEED  Generate N strings (1 by default) as JSON
+    GET /stats                   Request count and p50/p99 latency as JSON
+
+    Request latency runs from reading the request line to writing the last
+    byte of the response. Handler latency only covers building the response.
+    """
+
+    def __init__(self, data):
+        """Creates a WordServer
+
+        :param data: The trained (or loaded) WordData to generate from
+        """
+
+        self.data = data
+        self.num_requests = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.handler_latencies = deque(maxlen=LATENCY_WINDOW)
+
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until it closes
+
+        Connections are kept open between requests by default for HTTP/1.1
+        and closed by default for HTTP/1.0, and the Connection header
+        overrides either.
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start = time.perf_counter()
+
+                # Only HTTP/1.1 keeps the connection open by default, and
+                # malformed request lines get their 400 and a close
+                parts = request_line.decode('latin-1').split()
+                keep_alive = len(parts) == 3 and parts[2] != 'HTTP/1.0'
+
+                # Read the headers, keeping only what's needed
+                body_length = 0
+                bad_length = False
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    name = name.strip().lower()
+                    value = value.strip().lower()
+                    if name == 'connection':
+                        options = [option.strip()
+                                   for option in value.split(',')]
+                        if 'close' in options:
+                            keep_alive = False
+                        elif 'keep-alive' in options:
+                            keep_alive = True
+                    elif name == 'content-length':
+                        if value.isdigit():
+                            body_length = int(value)
+                        else:
+                            bad_length = True
+
+                if bad_length:
+                    # The body can't be skipped, so end the connection after
+                    # the response
+                    keep_alive = False
+                    status = 400
+                    body = b'{"error": "malformed Content-Length"}'
+                else:
+                    if body_length > 0:
+                        await reader.readexactly(body_length)
+
+                    handler_start = time.perf_counter()
+                    status, body = self.respond(request_line)
+                    self.handler_latencies.append(time.perf_counter()
+                                                  - handler_start)
+
+                writer.write(('HTTP/1.1 %d %s\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Content-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n'
+                              % (status, STATUS_TEXT[status], len(body),
+                                 'keep-alive' if keep_alive else 'close')
+                              ).encode('latin-1') + body)
+                await writer.drain()
+                self.latencies.append(time.perf_counter() - start)
+                self.num_requests += 1
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, request_line):
+        """Build the response to one request
+
+        :param request_line: The first line of the HTTP request, as bytes
+        :return: The HTTP status code and the JSON body as bytes
+        """
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            return 400, b'{"error": "malformed request"}'
+        method, target = parts[0], parts[1]
+        if method != 'GET':
+            return 405, b'{"error": "only GET is supported"}'
+
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if url.path == '/generate':
+            try:
+                n = int(query.get('n', ['1'])[0])
+            except ValueError:
+                return 400, b'{"error": "n must be an integer"}'
+            if not 0 < n <= MAX_BATCH:
+                return 400, (b'{"error": "n must be from 1 to %d"}'
+                             % MAX_BATCH)
+
+            seed = query.get('seed', [None])[0]
+            strings = MarkovWords.generate_batch(n, seed, data=self.data)
+            return 200, json.dumps({'strings': strings}).encode('utf-8')
+        elif url.path == '/stats':
+            return 200, json.dumps(self.stats()).encode('utf-8')
+
+        return 404, b'{"error": "not found"}'
+
+    def stats(self):
+        """Get the request count and the request and handler latency
+        percentiles in milliseconds
+        """
+
+        stats = {'requests': self.num_requests}
+        for prefix, window in (('', self.latencies),
+                               ('handler_', self.handler_latencies)):
+            latencies = sorted(window)
+            if len(latencies) > 0:
+                stats[prefix + 'p50_ms'] = 1000 * percentile(latencies, 50)
+                stats[prefix + 'p99_ms'] = 1000 * percentile(latencies, 99)
+        return stats
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                    unix_path=''):
+        """Serve until cancelled, on a TCP port or on a Unix socket
+
+        :param host: The host to listen on
+        :param port: The TCP port to listen on
+        :param unix_path: Listen on this Unix socket path instead, if given
+        """
+
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+
+        async with server:
+            await server.serve_forever()
+
+
+def percentile(values, percent):
+    """Get a percentile of a sorted list using the nearest rank
+
+    :param values: The sorted values
+    :param percent: The percentile, from 0 to 100
+    :return: The smallest value with at least percent% of values at or below
+    """
+
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[rank - 1]
+
+
+def printhelp():
+    # Print basic usage
+    print('\nUsage:  word_server.py [-h] [-rm FILE] [-p PORT] [-u PATH]\n')
+
+    # Print description of each option
+    print('[' + OPTIONS[0] + ']\t\tDisplay this help message')
+    print('[' + OPTIONS[1] + ' FILE]\tRead the model from a given file '
+                             '(trains on MarkovWords.FILES by default)')
+    print('[' + OPTIONS[2] + ' PORT]\tSet the TCP port to listen on '
+                             '(default ' + str(DEFAULT_PORT) + ')')
+    print('[' + OPTIONS[3] + ' PATH]\tListen on a Unix socket instead')
+
+
+def main():
+    """Train or load the model once, then serve generation requests
+    """
+
+    port = DEFAULT_PORT
+    unix_path = ''
+    in_model_path = ''
+
+    # Iterate over command line arguments
+    argv = ''
+    for i in range(1, len(sys.argv)):
+        # Get argument and potential option flag
+        prev = argv
+        argv = sys.argv[i]
+
+        if argv == '-h':
+            # Display usage information
+            printhelp()
+            exit(0)
+        elif argv in OPTIONS:
+            continue
+        elif prev == '-rm':
+            # Set the input model filepath
+            in_model_path = argv
+        elif prev == '-p':
+            # Set the TCP port
+            port = int(argv)
+        elif prev == '-u':
+            # Set the Unix socket path
+            unix_path = argv
+
+    # Train or load the model
+    if in_model_path:
+        MarkovWords.load_dicts(in_model_path)
+    else:
+        MarkovWords.construct_dicts()
+
+    server = WordServer(MarkovWords.word_data)
+    print('Serving on ' + (unix_path or '%s:%d' % (DEFAULT_HOST, port)))
+    try:
+        asyncio.run(server.serve(port=port, unix_path=unix_path))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()